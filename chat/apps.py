@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from django.core.signals import request_started
+        from . import signals  # noqa: F401
+        from .scheduler import START_DISPATCH_UID, ensure_started, scheduler_settings
+        if scheduler_settings()['AUTOSTART']:
+            request_started.connect(ensure_started, dispatch_uid=START_DISPATCH_UID)
@@ -0,0 +1,47 @@
+""" Attachment metadata captured once, so nothing downstream has to open or stat the file. """
+import hashlib
+import mimetypes
+
+from django.core.files.images import get_image_dimensions
+
+ATTACHMENT_FIELDS = ('file_size', 'file_content_type', 'file_sha256', 'image_width', 'image_height')
+
+
+def _image_size(file_obj, content_type):
+    if not content_type.startswith('image/'):
+        return None, None
+    try:
+        # Needs Pillow; without it we simply don't record dimensions.
+        return get_image_dimensions(file_obj)
+    except (ImportError, OSError, ValueError):
+        return None, None
+
+
+def describe(file_obj, name, declared_type=None):
+    """ Size, content type, SHA-256 and (for images) width/height of an open file. """
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in file_obj.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    file_obj.seek(0)
+
+    content_type = mimetypes.guess_type(name)[0] or declared_type or 'application/octet-stream'
+    width, height = _image_size(file_obj, content_type)
+    file_obj.seek(0)
+    return {
+        'file_size': size,
+        'file_content_type': content_type,
+        'file_sha256': digest.hexdigest(),
+        'image_width': width,
+        'image_height': height,
+    }
+
+
+def describe_upload(uploaded_file):
+    return describe(uploaded_file, uploaded_file.name, getattr(uploaded_file, 'content_type', None))
+
+
+def describe_stored(storage, path):
+    with storage.open(path, 'rb') as stored:
+        return describe(stored, path)
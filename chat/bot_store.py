@@ -0,0 +1,60 @@
+""" Cursor-paginated, cached listing for the bot store. """
+import hashlib
+
+from django.core.cache import cache
+
+from .models import Bot
+
+PAGE_SIZE = 24
+CACHE_TIMEOUT = 300
+VERSION_KEY = 'chat:bot_store:version'
+
+
+def listing_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def invalidate_listing():
+    """ Bumps the listing version so every cached page is ignored from now on. """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, timeout=None)
+
+
+def _fetch_page(prefix, cursor, exclude_owner_id):
+    bots = Bot.objects.all()
+    if exclude_owner_id is not None:
+        bots = bots.exclude(owner_id=exclude_owner_id)
+    if prefix:
+        # A half-open range on the indexed column instead of LIKE, so the index is used.
+        bots = bots.filter(search_name__gte=prefix, search_name__lt=prefix + '\uffff')
+    if cursor:
+        bots = bots.filter(id__lt=cursor)
+
+    rows = list(bots.order_by('-id').values(
+        'id', 'user_account__username', 'owner__username', 'group_count', 'channel_count',
+    )[:PAGE_SIZE + 1])
+    next_cursor = rows[PAGE_SIZE - 1]['id'] if len(rows) > PAGE_SIZE else None
+    return {'bots': rows[:PAGE_SIZE], 'next_cursor': next_cursor}
+
+
+def get_listing_page(user, prefix='', cursor=None):
+    """
+    Returns one page of bots not owned by `user`. Users without bots of their own all
+    see the same pages, so those are shared in the cache; bot owners get their own keys.
+    """
+    prefix = prefix.strip().lower()
+    exclude_owner_id = user.id if user.bots.exists() else None
+    key_parts = f"{prefix}|{cursor or ''}|{exclude_owner_id or 'shared'}"
+    key = f"chat:bot_store:{listing_version()}:{hashlib.md5(key_parts.encode()).hexdigest()}"
+
+    page = cache.get(key)
+    if page is None:
+        page = _fetch_page(prefix, cursor, exclude_owner_id)
+        cache.set(key, page, CACHE_TIMEOUT)
+    return page
@@ -0,0 +1,150 @@
+""" NDJSON export of conversations, streamed row by row so memory use stays flat. """
+import datetime
+import json
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .attachments import ATTACHMENT_FIELDS
+from .models import Message, Group, Channel, GroupMember, ChannelMember
+from .sharding import dm_key, message_shards, messages_for
+
+# 2: groups and channels are exported with a stable identity instead of a bare id.
+FORMAT_VERSION = 2
+CHUNK_SIZE = 2000
+
+MESSAGE_FIELDS = (
+    'id', 'sender_id', 'recipient_user_id', 'recipient_group_id', 'recipient_channel_id',
+    'text', 'file', 'timestamp', 'is_deleted', 'deleted_at',
+) + ATTACHMENT_FIELDS
+
+
+def dm_messages(user, other_user, live=False):
+    # With `live`, the condition goes inside each branch: SQLite plans OR branches on their own
+    # and would otherwise not pick the partial msg_dm_live_idx.
+    alive = Q(is_deleted=False) if live else Q()
+    return messages_for(dm_key(user.id, other_user.id)).filter(
+        (Q(sender=user) & Q(recipient_user=other_user) & alive) |
+        (Q(sender=other_user) & Q(recipient_user=user) & alive)
+    )
+
+
+def user_messages(user):
+    """ Every message the user can see: their DMs plus their groups and channels, one queryset per shard. """
+    # Memberships live on the primary, so resolve them here rather than joining from a shard.
+    group_ids = list(GroupMember.objects.filter(user=user).values_list('group_id', flat=True))
+    channel_ids = list(ChannelMember.objects.filter(user=user).values_list('channel_id', flat=True))
+    return [
+        Message.objects.using(alias).filter(
+            Q(sender=user) | Q(recipient_user=user) |
+            Q(recipient_group_id__in=group_ids) | Q(recipient_channel_id__in=channel_ids)
+        )
+        for alias in message_shards()
+    ]
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _resolve(cache, wanted, fetch):
+    """ Fills `cache` with the wanted ids it lacks, starting over once it gets large. """
+    wanted.discard(None)
+    missing = wanted - cache.keys()
+    if len(cache) + len(missing) > 50000:
+        cache.clear()
+        missing = wanted
+    if missing:
+        cache.update(fetch(missing))
+
+
+def _chat_identities(model, ids):
+    # Ids differ between instances; name, creator and creation time identify a group or channel.
+    for row in model.objects.filter(id__in=ids).values('id', 'name', 'creator__username', 'created_at'):
+        yield row['id'], {'id': row['id'], 'name': row['name'], 'creator': row['creator__username'],
+                          'created_at': row['created_at']}
+
+
+def _iter_rows(querysets):
+    """ Streams message rows with users, groups and channels resolved on the primary one chunk at a time. """
+    usernames, groups, channels = {}, {}, {}
+    for messages in querysets:
+        rows = messages.order_by('id').values(*MESSAGE_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+        for chunk in _chunks(rows, CHUNK_SIZE):
+            _resolve(usernames, {row['sender_id'] for row in chunk} | {row['recipient_user_id'] for row in chunk},
+                     lambda ids: User.objects.filter(id__in=ids).values_list('id', 'username'))
+            _resolve(groups, {row['recipient_group_id'] for row in chunk},
+                     lambda ids: _chat_identities(Group, ids))
+            _resolve(channels, {row['recipient_channel_id'] for row in chunk},
+                     lambda ids: _chat_identities(Channel, ids))
+            for row in chunk:
+                row['sender'] = usernames.get(row['sender_id'])
+                row['recipient_user'] = usernames.get(row['recipient_user_id'])
+                row['recipient_group'] = groups.get(row['recipient_group_id'])
+                row['recipient_channel'] = channels.get(row['recipient_channel_id'])
+                yield row
+
+
+def iter_records(messages, scope):
+    """
+    Yields a header, then one record per message followed by its attachment entry, if any.
+    `messages` is a queryset or a list of them (one per shard).
+    """
+    yield {'type': 'header', 'version': FORMAT_VERSION, 'scope': scope}
+
+    storage = Message._meta.get_field('file').storage
+    querysets = messages if isinstance(messages, (list, tuple)) else [messages]
+    for row in _iter_rows(querysets):
+        if row['is_deleted']:
+            # Same masking as the message list: a tombstone carries no content or attachment.
+            row.update(text=None, file=None, **{field: None for field in ATTACHMENT_FIELDS})
+        yield {
+            'type': 'message',
+            'id': row['id'],
+            'sender': row['sender'],
+            'recipient_user': row['recipient_user'],
+            'recipient_group': row['recipient_group'],
+            'recipient_channel': row['recipient_channel'],
+            'text': row['text'],
+            'file': row['file'] or None,
+            'timestamp': row['timestamp'],
+            'is_deleted': row['is_deleted'],
+            'deleted_at': row['deleted_at'],
+        }
+        if row['file']:
+            size = row['file_size']
+            if size is None and storage.exists(row['file']):
+                # Not backfilled yet (see backfill_attachment_metadata).
+                size = storage.size(row['file'])
+            yield {
+                'type': 'attachment',
+                'message_id': row['id'],
+                'path': row['file'],
+                'size': size,
+                'content_type': row['file_content_type'] or None,
+                'sha256': row['file_sha256'] or None,
+                'width': row['image_width'],
+                'height': row['image_height'],
+            }
+
+
+class ExportEncoder(DjangoJSONEncoder):
+    """ Keeps full microsecond precision so re-imported messages sort exactly as before. """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def iter_ndjson(records):
+    for record in records:
+        yield json.dumps(record, cls=ExportEncoder) + '\n'
@@ -0,0 +1,129 @@
+"""
+Optional group commit for message inserts. Sends that arrive within WINDOW_MS of each other
+are written together: the first request into an empty queue becomes the leader, waits out the
+window (or until MAX_BATCH requests have joined), and inserts the whole batch with one
+bulk_create per shard in a single transaction, so one commit and one fsync covers them all.
+The other requests wait for the leader and then carry on with their own saved Message, or the
+exception their row raised.
+"""
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import Message
+from .sharding import assign_message_ids, shard_for_message
+
+DEFAULTS = {
+    'ENABLED': False,
+    'WINDOW_MS': 5,
+    'MAX_BATCH': 200,
+}
+
+
+def group_commit_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_GROUP_COMMIT', {})}
+
+
+class _Entry:
+    __slots__ = ('message', 'alias', 'error', 'done')
+
+    def __init__(self, message, alias):
+        self.message = message
+        self.alias = alias
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+
+    def __init__(self, options):
+        self.window = options['WINDOW_MS'] / 1000
+        self.max_batch = options['MAX_BATCH']
+        self._lock = threading.Lock()
+        self._pending = []
+        self._full = threading.Event()
+
+    def save(self, message):
+        """ Inserts `message` as part of the current batch and returns it with its id set. """
+        alias = shard_for_message(message, for_write=True)
+        if transaction.get_connection(alias).in_atomic_block:
+            # The caller's transaction has to contain the row, so it can't ride on someone else's commit.
+            message.save(using=alias, force_insert=True)
+            return message
+
+        entry = _Entry(message, alias)
+        with self._lock:
+            self._pending.append(entry)
+            leader = len(self._pending) == 1
+            if leader:
+                self._full = threading.Event()
+            elif len(self._pending) >= self.max_batch:
+                self._full.set()
+            full = self._full
+
+        if leader:
+            full.wait(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            self._flush(batch)
+        else:
+            entry.done.wait()
+
+        if entry.error is not None:
+            raise entry.error
+        return message
+
+    def _flush(self, batch):
+        by_alias = {}
+        for entry in batch:
+            by_alias.setdefault(entry.alias, []).append(entry)
+        try:
+            for alias, entries in by_alias.items():
+                try:
+                    self._insert(alias, [entry.message for entry in entries])
+                except Exception:
+                    # One bad row shouldn't fail the batch: retry each on its own so only its sender sees the error.
+                    for entry in entries:
+                        try:
+                            with transaction.atomic(using=alias):
+                                entry.message.save(using=alias, force_insert=True)
+                        except Exception as e:
+                            entry.error = e
+        finally:
+            for entry in batch:
+                entry.done.set()
+
+    def _insert(self, alias, messages):
+        assign_message_ids(messages)
+        with transaction.atomic(using=alias):
+            if connections[alias].features.can_return_rows_from_bulk_insert or all(m.pk for m in messages):
+                Message.objects.using(alias).bulk_create(messages, batch_size=self.max_batch)
+            else:
+                # Without RETURNING there is no way to learn bulk ids; still one transaction, one commit.
+                for message in messages:
+                    message.save(using=alias, force_insert=True)
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def get_committer():
+    global _committer
+    options = group_commit_settings()
+    if not options['ENABLED']:
+        return None
+    with _committer_lock:
+        if _committer is None:
+            _committer = GroupCommitter(options)
+        return _committer
+
+
+def create_message(**fields):
+    """ Message.objects.create(), batched with concurrent sends when group commit is enabled. """
+    committer = get_committer()
+    # Attachments are written to storage during the insert; keep that I/O out of the shared batch.
+    if committer is None or fields.get('file'):
+        return Message.objects.create(**fields)
+    return committer.save(Message(**fields))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.attachments import ATTACHMENT_FIELDS, describe_stored
+from chat.models import Message
+from chat.sharding import message_shards
+
+
+class Command(BaseCommand):
+    help = "Fills in size, content type, hash and image dimensions for attachments uploaded before they were recorded."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Messages read and updated per transaction.')
+        parser.add_argument('--sleep', type=float, default=0.05,
+                            help='Seconds to pause between batches so other writers can get in.')
+
+    def handle(self, *args, **options):
+        storage = Message._meta.get_field('file').storage
+        updated = missing = 0
+        for alias in message_shards():
+            pending = (Message.objects.using(alias).exclude(file='').exclude(file__isnull=True)
+                       .filter(file_size__isnull=True).order_by('id').only('id', 'file'))
+            last_id = 0
+            while True:
+                batch = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                described = []
+                for message in batch:
+                    try:
+                        metadata = describe_stored(storage, message.file.name)
+                    except (FileNotFoundError, OSError):
+                        missing += 1
+                        continue
+                    for field, value in metadata.items():
+                        setattr(message, field, value)
+                    described.append(message)
+
+                if described:
+                    with transaction.atomic(using=alias):
+                        Message.objects.using(alias).bulk_update(described, ATTACHMENT_FIELDS)
+                    updated += len(described)
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f"Recorded metadata for {updated} attachments; {missing} files missing from storage."))
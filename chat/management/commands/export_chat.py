@@ -0,0 +1,51 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import dm_messages, user_messages, iter_records, iter_ndjson
+from chat.models import Group, Channel
+from chat.sharding import messages_for, group_key, channel_key
+
+
+class Command(BaseCommand):
+    help = "Streams a conversation, or everything a user can see, to NDJSON with an attachment manifest."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username whose data is exported.')
+        parser.add_argument('--with', dest='other', help='With --user, export only the DM with this username.')
+        parser.add_argument('--group', type=int, help='Export a single group by id.')
+        parser.add_argument('--channel', type=int, help='Export a single channel by id.')
+        parser.add_argument('-o', '--output', help='File to write to; defaults to stdout.')
+
+    def handle(self, *args, **options):
+        if options['group']:
+            group = self._get(Group, id=options['group'])
+            messages, scope = messages_for(group_key(group.id)).filter(recipient_group=group), {'group': group.id}
+        elif options['channel']:
+            channel = self._get(Channel, id=options['channel'])
+            messages, scope = messages_for(channel_key(channel.id)).filter(recipient_channel=channel), {'channel': channel.id}
+        elif options['user']:
+            user = self._get(User, username=options['user'])
+            if options['other']:
+                other = self._get(User, username=options['other'])
+                messages, scope = dm_messages(user, other), {'users': [user.username, other.username]}
+            else:
+                messages, scope = user_messages(user), {'user': user.username}
+        else:
+            raise CommandError('Pass one of --user, --group or --channel.')
+
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            for line in iter_ndjson(iter_records(messages, scope)):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    @staticmethod
+    def _get(model, **lookup):
+        try:
+            return model.objects.get(**lookup)
+        except model.DoesNotExist:
+            raise CommandError(f'{model.__name__} matching {lookup} does not exist.')
@@ -0,0 +1,176 @@
+import hashlib
+import json
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from chat.models import Group, Channel, Message, preserved_timestamps
+from chat.sharding import assign_message_ids, message_shards, shard_for_message
+
+
+@contextmanager
+def deferred_indexes(enabled):
+    """ Drops Message's secondary indexes on every shard for the load and rebuilds each one in a single pass after. """
+    indexes = list(Message._meta.indexes) if enabled else []
+    aliases = message_shards() if enabled else []
+    for alias in aliases:
+        with connections[alias].schema_editor() as editor:
+            for index in indexes:
+                editor.remove_index(Message, index)
+    try:
+        yield
+    finally:
+        for alias in aliases:
+            with connections[alias].schema_editor() as editor:
+                for index in indexes:
+                    editor.add_index(Message, index)
+
+
+UNMAPPED = object()
+
+
+def import_key(record):
+    """ Stable per exported message, so the same file imported twice is only loaded once. """
+    return hashlib.sha256(f"{record['id']}|{record['sender']}|{record['timestamp']}".encode()).hexdigest()
+
+
+def chat_index(model):
+    """ Groups or channels on this instance, by id and by (name, creator username). """
+    by_id, by_name = {}, {}
+    for pk, name, creator, created_at in model.objects.values_list('id', 'name', 'creator__username', 'created_at'):
+        by_id[pk] = (name, creator, created_at)
+        by_name.setdefault((name, creator), []).append(pk)
+    return by_id, by_name
+
+
+def map_chat(identity, index, same_database):
+    """ Local id of an exported group or channel, None when there is none, or UNMAPPED. """
+    if identity is None:
+        return None
+    by_id, by_name = index
+    if isinstance(identity, int):
+        # Format 1 exported bare ids, which only mean something in the database they came from.
+        return identity if same_database and identity in by_id else UNMAPPED
+    name, creator = identity['name'], identity['creator']
+    known = by_id.get(identity['id'])
+    if known and known[:2] == (name, creator):
+        return identity['id']
+    candidates = by_name.get((name, creator), [])
+    if len(candidates) > 1:
+        created_at = parse_datetime(identity['created_at'])
+        candidates = [pk for pk in candidates if by_id[pk][2] == created_at]
+    return candidates[0] if len(candidates) == 1 else UNMAPPED
+
+
+class Command(BaseCommand):
+    help = "Bulk-loads messages from an export_chat NDJSON file using batched bulk_create."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file produced by export_chat or the export/ endpoint.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Messages inserted per bulk_create and per transaction.')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drop the Message indexes during the load and rebuild them at the end.')
+        parser.add_argument('--same-database', action='store_true',
+                            help='Trust the bare group/channel ids in format 1 files (restoring into the database they came from).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Users, groups and channels must already exist; they are resolved once up front.
+        user_ids = dict(User.objects.values_list('username', 'id'))
+        groups = chat_index(Group)
+        channels = chat_index(Channel)
+
+        imported = skipped = unmapped = already = missing_files = 0
+        storage = Message._meta.get_field('file').storage
+        batches = {}  # shard alias -> pending messages
+        last_message = (None, None)  # (exported id, unsaved Message) for the attachment record that follows
+
+        def flush(alias):
+            nonlocal imported, already
+            batch = batches.pop(alias)
+            shard = Message.objects.using(alias)
+            # Skip what an earlier run imported, and originals still present when restoring in place.
+            seen = set(shard.filter(import_key__in=[m.import_key for m in batch]).values_list('import_key', flat=True))
+            originals = set(shard.filter(id__in=[m.export_id for m in batch]).values_list('id', 'sender_id', 'timestamp'))
+            fresh = []
+            for message in batch:
+                if message.import_key in seen or (message.export_id, message.sender_id, message.timestamp) in originals:
+                    already += 1
+                    continue
+                seen.add(message.import_key)
+                fresh.append(message)
+            assign_message_ids(fresh)
+            with transaction.atomic(using=alias):
+                shard.bulk_create(fresh, batch_size=batch_size)
+            imported += len(fresh)
+
+        try:
+            source = open(options['path'], encoding='utf-8')
+        except OSError as e:
+            raise CommandError(str(e))
+
+        with source, preserved_timestamps(), deferred_indexes(options['defer_indexes']):
+            for line_no, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise CommandError(f'Line {line_no} is not valid JSON.')
+
+                if record.get('type') == 'attachment':
+                    if not storage.exists(record['path']):
+                        missing_files += 1
+                    exported_id, message = last_message
+                    if message is not None and exported_id == record.get('message_id'):
+                        message.file_size = record.get('size')
+                        message.file_content_type = record.get('content_type') or ''
+                        message.file_sha256 = record.get('sha256') or ''
+                        message.image_width = record.get('width')
+                        message.image_height = record.get('height')
+                    continue
+                if record.get('type') != 'message':
+                    continue
+
+                sender_id = user_ids.get(record['sender'])
+                recipient_user_id = user_ids.get(record['recipient_user']) if record['recipient_user'] else None
+                if sender_id is None or (record['recipient_user'] and recipient_user_id is None):
+                    skipped += 1
+                    continue
+                group_id = map_chat(record['recipient_group'], groups, options['same_database'])
+                channel_id = map_chat(record['recipient_channel'], channels, options['same_database'])
+                if group_id is UNMAPPED or channel_id is UNMAPPED:
+                    unmapped += 1
+                    continue
+
+                message = Message(
+                    sender_id=sender_id,
+                    recipient_user_id=recipient_user_id,
+                    recipient_group_id=group_id,
+                    recipient_channel_id=channel_id,
+                    text=record['text'],
+                    file=record['file'] or None,
+                    timestamp=parse_datetime(record['timestamp']),
+                    is_deleted=record['is_deleted'],
+                    deleted_at=parse_datetime(record['deleted_at']) if record['deleted_at'] else None,
+                    import_key=import_key(record),
+                )
+                message.export_id = record['id']
+                alias = shard_for_message(message, for_write=True)
+                # Flush before appending so the newest message can still take its attachment record.
+                if len(batches.get(alias, ())) >= batch_size:
+                    flush(alias)
+                batches.setdefault(alias, []).append(message)
+                last_message = (record['id'], message)
+            for alias in list(batches):
+                flush(alias)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {imported} messages; {already} were already present, {skipped} had unknown users "
+            f"and {unmapped} belonged to groups or channels that don't exist here. "
+            f"{missing_files} attachments missing from storage."
+        ))
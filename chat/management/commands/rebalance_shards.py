@@ -0,0 +1,152 @@
+import time
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from chat.models import ConversationShard, Message, preserved_timestamps
+from chat.sharding import (
+    DIRECTORY_TTL, PRIMARY_DB, channel_key, conversation_q, dm_key, forget, group_key, message_shards,
+)
+
+
+class Command(BaseCommand):
+    help = ("Moves conversations between message shards. Use --fraction to split a shard, "
+            "--keys to move specific conversations, or --record-only to pin existing history in place.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='source', help='Shard to move conversations off.')
+        parser.add_argument('--to', dest='target', help='Shard to move conversations onto.')
+        parser.add_argument('--keys', nargs='+', default=[], help="Conversation keys, e.g. group:12 dm:3_7.")
+        parser.add_argument('--fraction', type=float,
+                            help='Move this share (0-1) of the source shard, picked by key hash.')
+        parser.add_argument('--record-only', action='store_true',
+                            help='Only record where existing conversations live, then stop.')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--settle', type=float, default=DIRECTORY_TTL,
+                            help='Seconds to wait after switching the directory before the final catch-up copy.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        shards = message_shards()
+        recorded = self.record_existing(shards)
+        self.stdout.write(f"Recorded placement for {recorded} previously unrecorded conversations.")
+        if options['record_only']:
+            return
+
+        source, target = options['source'], options['target']
+        if target not in shards or (source and source not in shards):
+            raise CommandError(f"--from/--to must be among CHAT_MESSAGE_SHARDS: {', '.join(shards)}")
+
+        entries = ConversationShard.objects.using(PRIMARY_DB).exclude(alias=target)
+        if options['keys']:
+            entries = entries.filter(key__in=options['keys'])
+        elif source and options['fraction'] is not None:
+            threshold = int(options['fraction'] * 1000)
+            entries = [entry for entry in entries.filter(alias=source).iterator()
+                       if zlib.crc32(entry.key.encode()) % 1000 < threshold]
+        else:
+            raise CommandError('Pass --keys, or --from together with --fraction.')
+        moves = [(entry.key, entry.alias) for entry in entries]
+
+        if options['dry_run'] or not moves:
+            self.stdout.write(f"{len(moves)} conversations would move to {target}.")
+            return
+
+        started = timezone.now()
+        for key, alias in moves:
+            self.copy(key, alias, target, options['batch_size'])
+
+        # Switch the directory, then give every worker time to drop its cached entry
+        # before picking up whatever was still written to the old shard meanwhile.
+        with transaction.atomic(using=PRIMARY_DB):
+            for key, _ in moves:
+                ConversationShard.objects.using(PRIMARY_DB).filter(key=key).update(alias=target)
+                forget(key)
+        time.sleep(options['settle'])
+
+        moved = 0
+        for key, alias in moves:
+            moved += self.finish(key, alias, target, started, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Moved {len(moves)} conversations ({moved} messages) to {target}."))
+
+    def record_existing(self, shards):
+        """ Pins every conversation that already has messages to the shard it is on. """
+        if len(shards) == 1:
+            return 0
+        known = set(ConversationShard.objects.using(PRIMARY_DB).values_list('key', flat=True))
+        new_entries = []
+        for alias in shards:
+            messages = Message.objects.using(alias)
+            keys = {group_key(pk) for pk in messages.filter(recipient_group__isnull=False)
+                    .values_list('recipient_group_id', flat=True).distinct()}
+            keys |= {channel_key(pk) for pk in messages.filter(recipient_channel__isnull=False)
+                     .values_list('recipient_channel_id', flat=True).distinct()}
+            keys |= {dm_key(a, b) for a, b in messages.filter(recipient_user__isnull=False)
+                     .values_list('sender_id', 'recipient_user_id').distinct()}
+            for key in keys - known:
+                new_entries.append(ConversationShard(key=key, alias=alias))
+                known.add(key)
+        ConversationShard.objects.using(PRIMARY_DB).bulk_create(new_entries, ignore_conflicts=True)
+        return len(new_entries)
+
+    def copy(self, key, source, target, batch_size):
+        """
+        Copies every source row the target doesn't have yet, ids preserved. Ids come from
+        per-process clocks, so a late commit can land below rows already copied; this walks
+        the whole conversation rather than resuming from the highest id seen.
+        """
+        messages = Message.objects.using(source).filter(conversation_q(key)).order_by('id')
+        copied = 0
+        last_id = 0
+        while True:
+            batch = list(messages.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                return copied
+            last_id = batch[-1].id
+            present = {row[0]: row[1:] for row in Message.objects.using(target)
+                       .filter(id__in=[message.id for message in batch])
+                       .values_list('id', 'sender_id', 'timestamp')}
+            missing = []
+            for message in batch:
+                if message.id not in present:
+                    missing.append(message)
+                elif present[message.id] != (message.sender_id, message.timestamp):
+                    raise CommandError(f"Message id {message.id} already exists on {target} as a different "
+                                       f"message; stopping before anything is dropped from {source}.")
+            for message in missing:
+                message._state.db = target
+            with transaction.atomic(using=target), preserved_timestamps():
+                Message.objects.using(target).bulk_create(missing)
+            copied += len(missing)
+
+    def finish(self, key, source, target, since, batch_size):
+        """ Catches up, then drops from the source only rows confirmed present on the target. """
+        dropped = 0
+        for _ in range(3):
+            self.copy(key, source, target, batch_size)
+            self.sync_deletions(key, source, target, since)
+            dropped += self.drop(key, source, target, batch_size)
+            if not Message.objects.using(source).filter(conversation_q(key)).exists():
+                return dropped
+        raise CommandError(f"{key} is still receiving messages on {source}; its directory entry points at "
+                           f"{target}. Re-run with --keys {key} --to {target} once writers have caught up.")
+
+    def sync_deletions(self, key, source, target, since):
+        deleted = Message.objects.using(source).filter(conversation_q(key), is_deleted=True, deleted_at__gte=since)
+        for message_id, deleted_at in deleted.values_list('id', 'deleted_at'):
+            Message.objects.using(target).filter(id=message_id).update(is_deleted=True, deleted_at=deleted_at, text=None)
+
+    def drop(self, key, source, target, batch_size):
+        messages = Message.objects.using(source).filter(conversation_q(key)).order_by('id')
+        dropped = 0
+        last_id = 0
+        while True:
+            ids = list(messages.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return dropped
+            last_id = ids[-1]
+            confirmed = list(Message.objects.using(target).filter(id__in=ids).values_list('id', flat=True))
+            with transaction.atomic(using=source):
+                dropped += Message.objects.using(source).filter(id__in=confirmed).delete()[0]
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from chat.scheduler import MessageScheduler, scheduler_settings
+
+
+class Command(BaseCommand):
+    help = "Runs the scheduled-message dispatcher in the foreground (use with CHAT_SCHEDULER['AUTOSTART'] = False)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages claimed and sent per batch.')
+        parser.add_argument('--horizon', type=int, help='Seconds ahead of now to keep in memory.')
+
+    def handle(self, *args, **options):
+        config = scheduler_settings()
+        if options['batch_size']:
+            config['BATCH_SIZE'] = options['batch_size']
+        if options['horizon']:
+            config['HORIZON'] = options['horizon']
+
+        scheduler = MessageScheduler(config)
+        self.stdout.write(f"Dispatching scheduled messages (batches of {config['BATCH_SIZE']}). Ctrl-C to stop.")
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.stop()
+        self.stdout.write("Scheduler stopped.")
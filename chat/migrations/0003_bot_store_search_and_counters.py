@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:11
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_bot_store_fields(apps, schema_editor):
+    Bot = apps.get_model('chat', 'Bot')
+    bots = Bot.objects.select_related('user_account').annotate(
+        n_groups=Count('groups', distinct=True), n_channels=Count('channels', distinct=True),
+    )
+    for bot in bots.iterator():
+        Bot.objects.filter(pk=bot.pk).update(
+            search_name=bot.user_account.username.lower(),
+            group_count=bot.n_groups,
+            channel_count=bot.n_channels,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_soft_delete_compaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='channel_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bot',
+            name='group_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bot',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, max_length=150),
+        ),
+        migrations.RunPython(backfill_bot_store_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_user_handles(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    UserHandle = apps.get_model('chat', 'UserHandle')
+    handles = [UserHandle(user_id=user_id, key=username.lower())
+               for user_id, username in User.objects.values_list('id', 'username').iterator()]
+    UserHandle.objects.bulk_create(handles, batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0005_message_attachment_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserHandle',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='handle', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('key', models.CharField(db_index=True, max_length=150)),
+            ],
+        ),
+        migrations.RunPython(backfill_user_handles, migrations.RunPython.noop),
+    ]
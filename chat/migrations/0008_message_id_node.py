@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:37
+
+from django.db import migrations, models
+
+
+def create_nodes(apps, schema_editor):
+    # One row per node id: chat.sharding.NODE_BITS is 6.
+    MessageIdNode = apps.get_model('chat', 'MessageIdNode')
+    MessageIdNode.objects.bulk_create([MessageIdNode(node=node) for node in range(64)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_scheduled_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageIdNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node', models.PositiveSmallIntegerField(unique=True)),
+                ('owner', models.CharField(blank=True, max_length=100)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(create_nodes, migrations.RunPython.noop),
+    ]
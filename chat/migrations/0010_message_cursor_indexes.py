@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_import_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='msg_group_live_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='msg_channel_live_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='msg_dm_live_idx',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='recipient_channel',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.channel'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='recipient_group',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.group'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient_group', 'id'], name='msg_group_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient_channel', 'id'], name='msg_channel_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'recipient_user', 'id'], name='msg_dm_id_idx'),
+        ),
+    ]
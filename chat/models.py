@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from contextlib import contextmanager
 import os
 import secrets
 
@@ -15,6 +16,14 @@ def get_upload_path(instance, filename):
         return os.path.join('dm_files', f"{user_ids[0]}_{user_ids[1]}", filename)
     return os.path.join('misc_files', filename)
 
+def normalize_username(username):
+    return username.lower()
+
+class UserHandle(models.Model):
+    """ Normalized username kept next to auth_user so case-insensitive lookups are a plain index probe. """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='handle')
+    key = models.CharField(max_length=150, db_index=True)
+
 class Contact(models.Model):
     user = models.ForeignKey(User, related_name='contacts', on_delete=models.CASCADE)
     contact_user = models.ForeignKey(User, related_name='contact_of', on_delete=models.CASCADE)
@@ -27,10 +36,16 @@ class Bot(models.Model):
     user_account = models.OneToOneField(User, on_delete=models.CASCADE, related_name='bot_profile')
     token = models.CharField(max_length=64, unique=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Lowercased username, indexed so the bot store can do prefix search as a range scan.
+    search_name = models.CharField(max_length=150, db_index=True, blank=True)
+    # Denormalized popularity, kept current by the m2m signals in chat/signals.py.
+    group_count = models.PositiveIntegerField(default=0)
+    channel_count = models.PositiveIntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.token:
             self.token = secrets.token_hex(32)
+        self.search_name = self.user_account.username.lower()
         super().save(*args, **kwargs)
     def __str__(self):
         return self.user_account.username
@@ -78,14 +93,127 @@ class ChannelMember(MemberPermissions):
     class Meta:
         unique_together = ('channel', 'user')
 
+class MessageQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Let the router place a new message by its conversation unless a database was picked with using().
+        if self._db is None:
+            message = self.model(**kwargs)
+            message.save(force_insert=True)
+            return message
+        return super().create(**kwargs)
+
 class Message(models.Model):
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
-    recipient_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages', null=True, blank=True)
-    recipient_group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='messages', null=True, blank=True)
-    recipient_channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='messages', null=True, blank=True)
+    # No database-level constraints: with sharding on, the rows these point at live on the primary.
+    # sender, recipient_group and recipient_channel are covered by the composite indexes in Meta.
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages', db_constraint=False, db_index=False)
+    recipient_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages', null=True, blank=True, db_constraint=False)
+    recipient_group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='messages', null=True, blank=True, db_constraint=False, db_index=False)
+    recipient_channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='messages', null=True, blank=True, db_constraint=False, db_index=False)
     text = models.TextField(null=True, blank=True)
     file = models.FileField(upload_to=get_upload_path, null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     is_deleted = models.BooleanField(default=False)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Attachment metadata, filled in once at upload (see chat/attachments.py).
+    file_size = models.BigIntegerField(null=True, blank=True)
+    file_content_type = models.CharField(max_length=100, blank=True, db_index=True)
+    file_sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+    # Set by import_chat from the exported record, so importing the same file twice adds nothing.
+    import_key = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            # History is read in id-cursor pages that include tombstones, one conversation at a time.
+            models.Index(fields=['recipient_group', 'id'], name='msg_group_id_idx'),
+            models.Index(fields=['recipient_channel', 'id'], name='msg_channel_id_idx'),
+            models.Index(fields=['sender', 'recipient_user', 'id'], name='msg_dm_id_idx'),
+            # Unread counts, latest-message previews and full loads only want live rows; keep tombstones out.
+            models.Index(fields=['recipient_group', 'id'], condition=models.Q(is_deleted=False),
+                         name='msg_group_live_idx'),
+            models.Index(fields=['recipient_channel', 'id'], condition=models.Q(is_deleted=False),
+                         name='msg_channel_live_idx'),
+            models.Index(fields=['sender', 'recipient_user', 'id'], condition=models.Q(is_deleted=False),
+                         name='msg_dm_live_idx'),
+            # Lets the purge job find old tombstones without scanning live history.
+            models.Index(fields=['deleted_at'], condition=models.Q(is_deleted=True),
+                         name='msg_tombstone_idx'),
+            # Lets the purge job check whether any other message still uses a file; text-only rows stay out.
+            models.Index(fields=['file'], condition=models.Q(file__gt=''), name='msg_file_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['import_key'], condition=models.Q(import_key__isnull=False),
+                                    name='msg_import_key_uniq'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.pk is None:
+            from .sharding import sharding_enabled, next_message_id
+            if sharding_enabled():
+                self.pk = next_message_id()
+                kwargs.setdefault('force_insert', True)
+        super().save(*args, **kwargs)
+
+@contextmanager
+def preserved_timestamps():
+    """ Lets bulk_create keep each Message's own timestamp instead of stamping the current time. """
+    field = Message._meta.get_field('timestamp')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+class ConversationShard(models.Model):
+    """ Directory entry saying which message database holds a conversation. Lives on the primary. """
+    key = models.CharField(max_length=64, unique=True)  # 'dm:3_7', 'group:12', 'channel:5'
+    alias = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} -> {self.alias}"
+
+class MessageIdNode(models.Model):
+    """ One of the node ids embedded in sharded message ids. Each process leases its own (see chat/sharding.py). """
+    node = models.PositiveSmallIntegerField(unique=True)
+    owner = models.CharField(max_length=100, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"node {self.node} -> {self.owner or 'free'}"
+
+class ScheduledMessage(models.Model):
+    """ A message held back until send_at; chat/scheduler.py turns it into a Message. Lives on the primary. """
+    PENDING, SENDING, SENT, CANCELLED, FAILED = 'pending', 'sending', 'sent', 'cancelled', 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'),
+                      (CANCELLED, 'Cancelled'), (FAILED, 'Failed')]
+
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='scheduled_messages')
+    recipient_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
+    recipient_group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='scheduled_messages', null=True, blank=True)
+    recipient_channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='scheduled_messages', null=True, blank=True)
+    text = models.TextField(null=True, blank=True)
+    file = models.FileField(upload_to=get_upload_path, null=True, blank=True)
+    file_size = models.BigIntegerField(null=True, blank=True)
+    file_content_type = models.CharField(max_length=100, blank=True)
+    file_sha256 = models.CharField(max_length=64, blank=True)
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+    send_at = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # A dispatcher claims a batch by stamping its token; stale claims are released after a lease.
+    claim_token = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    message_id = models.BigIntegerField(null=True, blank=True)  # the Message it became
+    created_at = models.DateTimeField(auto_now_add=True)
+
     class Meta:
-        ordering = ['timestamp']
\ No newline at end of file
+        indexes = [
+            # The scheduler only ever scans what is still waiting, in due order.
+            models.Index(fields=['send_at'], condition=models.Q(status='pending'), name='sched_pending_idx'),
+            models.Index(fields=['claimed_at'], condition=models.Q(status='sending'), name='sched_claimed_idx'),
+        ]
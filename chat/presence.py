@@ -0,0 +1,112 @@
+""" Ephemeral presence and typing state. Nothing here ever touches the database. """
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    'BACKEND': 'chat.presence.InMemoryPresenceBackend',
+    'CACHE_ALIAS': 'default',
+    'ONLINE_TTL': 60,
+    'TYPING_TTL': 6,
+    # Refreshes arriving sooner than this after the last accepted one are dropped.
+    'COALESCE_SECONDS': 2,
+}
+
+
+def presence_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+class InMemoryPresenceBackend:
+    """ Per-process TTL map. Fine for a single worker; use CachePresenceBackend for several. """
+
+    def __init__(self, options):
+        self.coalesce = options['COALESCE_SECONDS']
+        self._lock = threading.Lock()
+        self._expires = {}  # key -> (expires_at, touched_at)
+        self._next_sweep = 0
+
+    def touch(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._expires.get(key)
+            if entry and now - entry[1] < self.coalesce and entry[0] > now:
+                return False
+            self._expires[key] = (now + ttl, now)
+            if now >= self._next_sweep:
+                self._sweep(now)
+            return True
+
+    def clear(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def alive(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return {key for key in keys if key in self._expires and self._expires[key][0] > now}
+
+    def _sweep(self, now):
+        self._expires = {key: entry for key, entry in self._expires.items() if entry[0] > now}
+        self._next_sweep = now + self.coalesce * 10
+
+
+class CachePresenceBackend:
+    """ Stores presence keys in a Django cache so every worker sees the same state. """
+
+    def __init__(self, options):
+        self.cache = caches[options['CACHE_ALIAS']]
+        self.coalesce = options['COALESCE_SECONDS']
+        self._lock = threading.Lock()
+        self._last_write = {}  # key -> monotonic time of our last cache write
+
+    def touch(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_write.get(key)
+            if last is not None and now - last < self.coalesce:
+                return False
+            self._last_write[key] = now
+            if len(self._last_write) > 10000:
+                self._last_write = {k: t for k, t in self._last_write.items() if now - t < self.coalesce}
+        self.cache.set(self._cache_key(key), 1, timeout=ttl)
+        return True
+
+    def clear(self, key):
+        with self._lock:
+            self._last_write.pop(key, None)
+        self.cache.delete(self._cache_key(key))
+
+    def alive(self, keys):
+        keys = list(keys)
+        found = self.cache.get_many([self._cache_key(key) for key in keys])
+        return {key for key in keys if self._cache_key(key) in found}
+
+    @staticmethod
+    def _cache_key(key):
+        return f'chat:presence:{key}'
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_presence_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                options = presence_settings()
+                _backend = import_string(options['BACKEND'])(options)
+    return _backend
+
+
+def online_key(user_id):
+    return f'online:{user_id}'
+
+
+def typing_key(chat_type, chat_id, user_id):
+    return f'typing:{chat_type}:{chat_id}:{user_id}'
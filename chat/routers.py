@@ -0,0 +1,50 @@
+from .sharding import PRIMARY_DB, group_key, channel_key, message_shards, shard_for_key, shard_for_message
+
+
+class MessageShardRouter:
+    """
+    Sends Message reads and writes to the shard that holds their conversation; everything
+    else (users, contacts, groups, channels, memberships, bots) stays on the primary.
+
+    Queries that can't say which conversation they're for fall through to the primary, so
+    view code targets a shard explicitly with chat.sharding.messages_for().
+    """
+
+    def _is_message(self, model):
+        return model._meta.app_label == 'chat' and model._meta.model_name == 'message'
+
+    def _message_db(self, hints, for_write):
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        model_name = instance._meta.model_name
+        if instance._meta.app_label != 'chat':
+            return None
+        if model_name == 'message':
+            if instance._state.db and not instance._state.adding:
+                return instance._state.db
+            return shard_for_message(instance, for_write=for_write)
+        if model_name == 'group':
+            return shard_for_key(group_key(instance.pk), for_write=for_write)
+        if model_name == 'channel':
+            return shard_for_key(channel_key(instance.pk), for_write=for_write)
+        return None
+
+    def db_for_read(self, model, **hints):
+        if self._is_message(model):
+            return self._message_db(hints, for_write=False)
+        return PRIMARY_DB
+
+    def db_for_write(self, model, **hints):
+        if self._is_message(model):
+            return self._message_db(hints, for_write=True)
+        return PRIMARY_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Messages point at users, groups and channels on the primary by design.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'chat' and model_name == 'message':
+            return db == PRIMARY_DB or db in message_shards()
+        return db == PRIMARY_DB
@@ -0,0 +1,356 @@
+"""
+Scheduled sends. Pending ScheduledMessage rows due within the next HORIZON seconds are held
+in a min-heap of (send_at, id), so scheduling and firing are O(log n), and a background thread
+sleeps until the earliest one is due. Rows further out stay in the database and are pulled in
+by the periodic refill, which only reads what changed since the last one: rows added since
+(by any process), rows the moving horizon has just reached and claims left by a dead dispatcher.
+The heap is rebuilt in full at startup and, as a safety net, every RESYNC_INTERVAL.
+
+Several processes may run a scheduler: each batch is claimed with a conditional UPDATE before
+anything is sent. On the primary, the messages and the status change commit together; on other
+shards the message ids are recorded before the insert, so a claim released after a crash is
+settled by checking whether its message exists.
+"""
+import heapq
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from .attachments import ATTACHMENT_FIELDS
+from .models import ChannelMember, GroupMember, Message, ScheduledMessage
+from .sharding import PRIMARY_DB, assign_message_ids, conversation_key, shard_for_key, shard_for_message
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Also run the scheduler thread inside each web process, from its first request. Off by default:
+    # `manage.py run_scheduler` is the usual way to run it.
+    'AUTOSTART': False,
+    'BATCH_SIZE': 200,
+    'HORIZON': 3600,
+    # Seconds between incremental refills (new rows, rows entering the horizon, stale claims)...
+    'REFILL_INTERVAL': 15,
+    # ...and between full reloads, which only exist to catch anything those could miss.
+    'RESYNC_INTERVAL': 3600,
+    # A batch still marked as sending after this many seconds is assumed lost and retried.
+    'LEASE': 300,
+}
+
+
+def scheduler_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SCHEDULER', {})}
+
+
+def _allowed(rows):
+    """ Senders must still be allowed to post where they scheduled to; membership can change meanwhile. """
+    group_pairs = {(row.recipient_group_id, row.sender_id) for row in rows if row.recipient_group_id}
+    channel_pairs = {(row.recipient_channel_id, row.sender_id) for row in rows if row.recipient_channel_id}
+    members = set()
+    if group_pairs:
+        members |= {('group', g, u) for g, u in GroupMember.objects.filter(
+            group_id__in={g for g, _ in group_pairs}, user_id__in={u for _, u in group_pairs},
+        ).values_list('group_id', 'user_id')}
+    if channel_pairs:
+        members |= {('channel', c, u) for c, u in ChannelMember.objects.filter(
+            channel_id__in={c for c, _ in channel_pairs}, user_id__in={u for _, u in channel_pairs},
+            can_send_messages=True,
+        ).values_list('channel_id', 'user_id')}
+
+    def allowed(row):
+        if row.recipient_group_id:
+            return ('group', row.recipient_group_id, row.sender_id) in members
+        if row.recipient_channel_id:
+            return ('channel', row.recipient_channel_id, row.sender_id) in members
+        return True
+    return allowed
+
+
+def _insert(alias, messages):
+    assign_message_ids(messages)
+    if connections[alias].features.can_return_rows_from_bulk_insert or all(m.pk for m in messages):
+        Message.objects.using(alias).bulk_create(messages)
+    else:
+        for message in messages:
+            message.save(using=alias, force_insert=True)
+
+
+def _send(alias, pairs):
+    """ Inserts one shard's messages so that no crash can leave a row both sent and still claimable. """
+    rows = [row for row, _ in pairs]
+    messages = [message for _, message in pairs]
+    if alias == PRIMARY_DB:
+        # Same database as ScheduledMessage: the insert and the status change commit together.
+        with transaction.atomic(using=PRIMARY_DB):
+            _insert(alias, messages)
+            for row, message in pairs:
+                row.status, row.message_id = ScheduledMessage.SENT, message.pk
+            ScheduledMessage.objects.bulk_update(rows, ['status', 'message_id'])
+        return
+
+    # Another shard: record the ids first, so a claim released after a crash can check
+    # whether its message made it (see release_stale_claims).
+    assign_message_ids(messages)
+    for row, message in pairs:
+        row.message_id = message.pk
+    ScheduledMessage.objects.bulk_update(rows, ['message_id'])
+    with transaction.atomic(using=alias):
+        _insert(alias, messages)
+    for row in rows:
+        row.status = ScheduledMessage.SENT
+    ScheduledMessage.objects.bulk_update(rows, ['status'])
+
+
+def dispatch(ids, retry=None):
+    """
+    Claims the given rows if they are still pending and due, and sends them in one batch per shard.
+    Ids handed back to pending after a failed insert are passed to `retry`.
+    """
+    from .views import execute_bot_logic
+
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    claimed = ScheduledMessage.objects.filter(id__in=ids, status=ScheduledMessage.PENDING, send_at__lte=now).update(
+        status=ScheduledMessage.SENDING, claim_token=token, claimed_at=now,
+    )
+    if not claimed:
+        return 0
+
+    rows = list(ScheduledMessage.objects.filter(id__in=ids, claim_token=token)
+                .select_related('sender', 'recipient_user', 'recipient_group').order_by('send_at', 'id'))
+    allowed = _allowed(rows)
+    batches = {}  # shard alias -> [(row, message)]
+    refused = []
+    for row in rows:
+        if not allowed(row):
+            row.status = ScheduledMessage.FAILED
+            refused.append(row)
+            continue
+        message = Message(
+            sender=row.sender, recipient_user=row.recipient_user, recipient_group=row.recipient_group,
+            recipient_channel_id=row.recipient_channel_id, text=row.text, file=row.file.name or None,
+            **{field: getattr(row, field) for field in ATTACHMENT_FIELDS},
+        )
+        batches.setdefault(shard_for_message(message, for_write=True), []).append((row, message))
+    if refused:
+        ScheduledMessage.objects.bulk_update(refused, ['status'])
+
+    sent = []
+    for alias, pairs in batches.items():
+        try:
+            _send(alias, pairs)
+        except Exception:
+            logger.exception('Sending %d scheduled messages to %s failed; they will be retried.', len(pairs), alias)
+            # Hand the rows back unless the insert may have gone through; the lease sorts those out.
+            returned = list(ScheduledMessage.objects.filter(
+                id__in=[row.id for row, _ in pairs], status=ScheduledMessage.SENDING, message_id__isnull=True,
+            ).values_list('id', flat=True))
+            ScheduledMessage.objects.filter(id__in=returned, status=ScheduledMessage.SENDING).update(
+                status=ScheduledMessage.PENDING, claim_token='', claimed_at=None,
+            )
+            if retry is not None:
+                retry(returned)
+            continue
+        sent.extend(message for _, message in pairs)
+
+    for message in sent:
+        if message.text:
+            execute_bot_logic(message)
+    return len(sent)
+
+
+def release_stale_claims(lease):
+    """
+    Settles rows whose dispatcher died mid-batch: those whose message exists are marked sent,
+    the rest go back to pending. Returns the ids made pending again.
+    """
+    stale = list(ScheduledMessage.objects.filter(
+        status=ScheduledMessage.SENDING, claimed_at__lt=timezone.now() - timedelta(seconds=lease),
+    ).only('id', 'sender_id', 'recipient_user_id', 'recipient_group_id', 'recipient_channel_id', 'message_id'))
+    delivered = set()
+    by_alias = {}
+    for row in stale:
+        if row.message_id is not None:
+            by_alias.setdefault(shard_for_key(conversation_key(row)), []).append(row.message_id)
+    for alias, message_ids in by_alias.items():
+        delivered.update(Message.objects.using(alias).filter(id__in=message_ids).values_list('id', flat=True))
+
+    sent = [row.id for row in stale if row.message_id in delivered]
+    retry = [row.id for row in stale if row.message_id not in delivered]
+    ScheduledMessage.objects.filter(id__in=sent, status=ScheduledMessage.SENDING).update(status=ScheduledMessage.SENT)
+    ScheduledMessage.objects.filter(id__in=retry, status=ScheduledMessage.SENDING).update(
+        status=ScheduledMessage.PENDING, claim_token='', claimed_at=None, message_id=None,
+    )
+    return retry
+
+
+class MessageScheduler:
+
+    def __init__(self, options):
+        self.batch_size = options['BATCH_SIZE']
+        self.horizon = options['HORIZON']
+        self.refill_interval = options['REFILL_INTERVAL']
+        self.resync_interval = options['RESYNC_INTERVAL']
+        self.lease = options['LEASE']
+        self._heap = []  # (send_at timestamp, id)
+        self._queued = set()
+        self._horizon_end = 0
+        self._loaded_until = None  # send_at up to which pending rows have been read
+        # Highest row id seen at the last two refills. New rows are read from the older one, so a
+        # row whose insert committed just after a higher id was read is still picked up.
+        self._seen_ids = (0, 0)
+        self._resynced_at = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self.run, name='chat-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+    def add(self, scheduled):
+        """ Queues a newly scheduled row; anything beyond the loaded horizon waits for a refill. """
+        due = scheduled.send_at.timestamp()
+        with self._cond:
+            if due > self._horizon_end or scheduled.id in self._queued:
+                return
+            heapq.heappush(self._heap, (due, scheduled.id))
+            self._queued.add(scheduled.id)
+            if self._heap[0][1] == scheduled.id:
+                self._cond.notify()
+
+    def requeue(self, ids, delay=5):
+        """ Puts rows handed back by a failed dispatch on the heap again, a little later. """
+        due = time.time() + delay
+        with self._cond:
+            for pk in ids:
+                if pk not in self._queued:
+                    heapq.heappush(self._heap, (due, pk))
+                    self._queued.add(pk)
+
+    def _push(self, rows):
+        rows = list(rows)  # read before taking the lock, so add() isn't held up by the query
+        with self._cond:
+            pushed = False
+            for pk, send_at in rows:
+                if pk not in self._queued:
+                    heapq.heappush(self._heap, (send_at.timestamp(), pk))
+                    self._queued.add(pk)
+                    pushed = True
+            if pushed:
+                self._cond.notify()
+
+    def refill(self):
+        """ Reads only what changed since the last refill; a full reload at startup and every RESYNC_INTERVAL. """
+        now = timezone.now()
+        horizon_end = now + timedelta(seconds=self.horizon)
+        if self._resynced_at is None or time.monotonic() - self._resynced_at > self.resync_interval:
+            self.resync(now, horizon_end)
+            return
+
+        pending = ScheduledMessage.objects.filter(status=ScheduledMessage.PENDING)
+        released = release_stale_claims(self.lease)
+        if released:
+            self._push(pending.filter(id__in=released).values_list('id', 'send_at'))
+        # Rows added since the last refill (by any process) that are due within the horizon...
+        newest = ScheduledMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        self._push(pending.filter(id__gt=self._seen_ids[0], send_at__lte=horizon_end).values_list('id', 'send_at'))
+        # ...and older rows the moving horizon has just reached.
+        self._push(pending.filter(send_at__gt=self._loaded_until, send_at__lte=horizon_end).values_list('id', 'send_at'))
+        self._advance(horizon_end, newest)
+
+    def resync(self, now=None, horizon_end=None):
+        now = now or timezone.now()
+        horizon_end = horizon_end or now + timedelta(seconds=self.horizon)
+        release_stale_claims(self.lease)
+        newest = ScheduledMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        rows = ScheduledMessage.objects.filter(status=ScheduledMessage.PENDING, send_at__lte=horizon_end)
+        self._push(rows.values_list('id', 'send_at').iterator())
+        self._seen_ids = (newest, newest)
+        self._advance(horizon_end, newest)
+        self._resynced_at = time.monotonic()
+
+    def _advance(self, horizon_end, newest):
+        self._loaded_until = horizon_end
+        self._seen_ids = (self._seen_ids[1], newest)
+        with self._cond:
+            self._horizon_end = horizon_end.timestamp()
+
+    def take_due(self, now):
+        with self._cond:
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                _, pk = heapq.heappop(self._heap)
+                self._queued.discard(pk)
+                due.append(pk)
+            return due
+
+    def run(self):
+        next_refill = 0
+        while not self._stopping:
+            try:
+                now = time.time()
+                if now >= next_refill:
+                    self.refill()
+                    next_refill = now + self.refill_interval
+                due = self.take_due(now)
+                if due:
+                    dispatch(due, retry=self.requeue)
+                    continue
+            except Exception:
+                logger.exception('Scheduled message dispatch failed.')
+                next_refill = 0
+                time.sleep(1)
+                continue
+            finally:
+                close_old_connections()
+
+            with self._cond:
+                wake_at = next_refill
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                if not self._stopping:
+                    self._cond.wait(max(0, wake_at - time.time()))
+
+
+START_DISPATCH_UID = 'chat.scheduler.ensure_started'
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = MessageScheduler(scheduler_settings())
+        return _scheduler
+
+
+def ensure_started(**kwargs):
+    """ request_started receiver: starts the in-process scheduler with the first request, then unhooks itself. """
+    from django.core.signals import request_started
+    request_started.disconnect(dispatch_uid=START_DISPATCH_UID)
+    if scheduler_settings()['AUTOSTART']:
+        get_scheduler().start()
+
+
+def notify_scheduled(scheduled):
+    if scheduler_settings()['AUTOSTART']:
+        scheduler = get_scheduler()
+        scheduler.start()
+        scheduler.add(scheduled)
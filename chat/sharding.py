@@ -0,0 +1,251 @@
+"""
+Message placement across databases.
+
+Every Message belongs to one conversation (a DM pair, a group or a channel) and all of a
+conversation's messages live on one shard. Placement is recorded in ConversationShard on the
+primary database the first time a conversation is written to. A conversation without an
+entry stays on the primary if the primary already holds its history (it predates sharding);
+otherwise it is new and the shard is picked by hashing its key. With a single shard
+configured (the default) none of this touches the database.
+"""
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections
+from django.utils import timezone
+
+PRIMARY_DB = DEFAULT_DB_ALIAS
+DIRECTORY_TTL = 60  # seconds a worker trusts its cached copy of a directory entry
+
+_directory = {}  # key -> (alias, cached_at)
+_directory_lock = threading.Lock()
+
+
+def message_shards():
+    return list(getattr(settings, 'CHAT_MESSAGE_SHARDS', [PRIMARY_DB]))
+
+
+def sharding_enabled():
+    return len(message_shards()) > 1
+
+
+# --- Conversation keys ---
+def dm_key(user_a_id, user_b_id):
+    low, high = sorted([int(user_a_id), int(user_b_id)])
+    return f'dm:{low}_{high}'
+
+
+def group_key(group_id):
+    return f'group:{group_id}'
+
+
+def channel_key(channel_id):
+    return f'channel:{channel_id}'
+
+
+def conversation_key(message):
+    if message.recipient_group_id:
+        return group_key(message.recipient_group_id)
+    if message.recipient_channel_id:
+        return channel_key(message.recipient_channel_id)
+    return dm_key(message.sender_id, message.recipient_user_id)
+
+
+def conversation_q(key):
+    """ Filter matching the messages of conversation `key`. """
+    from django.db.models import Q
+    kind, _, ident = key.partition(':')
+    if kind == 'group':
+        return Q(recipient_group_id=int(ident))
+    if kind == 'channel':
+        return Q(recipient_channel_id=int(ident))
+    low, high = (int(part) for part in ident.split('_'))
+    return (Q(sender_id=low, recipient_user_id=high) | Q(sender_id=high, recipient_user_id=low))
+
+
+def key_for(item_type, item_id, user_id=None):
+    """ Key for a conversation as the views name it: ('user', other_id) needs the caller's id too. """
+    if item_type == 'user':
+        return dm_key(user_id, item_id)
+    if item_type == 'group':
+        return group_key(item_id)
+    if item_type == 'channel':
+        return channel_key(item_id)
+    raise ValueError(f'Unknown conversation type: {item_type}')
+
+
+# --- Placement ---
+def hashed_shard(key, shards=None):
+    shards = shards or message_shards()
+    return shards[zlib.crc32(key.encode()) % len(shards)]
+
+
+def _unrecorded_shard(key, shards):
+    # History written before a second shard was configured is all on the primary and unrecorded
+    # until `rebalance_shards --record-only` runs; it must not be split from its new messages.
+    from .models import Message
+    if PRIMARY_DB in shards and Message.objects.using(PRIMARY_DB).filter(conversation_q(key)).exists():
+        return PRIMARY_DB
+    return hashed_shard(key, shards)
+
+
+def shard_for_key(key, for_write=False):
+    """
+    Returns the database alias holding `key`. Writes record a placement the first time so
+    later changes to the shard list (or a rebalance) don't strand existing history.
+    """
+    shards = message_shards()
+    if len(shards) == 1:
+        return shards[0]
+
+    now = time.monotonic()
+    cached = _directory.get(key)
+    if cached and now - cached[1] < DIRECTORY_TTL:
+        return cached[0]
+
+    from .models import ConversationShard
+    alias = ConversationShard.objects.using(PRIMARY_DB).filter(key=key).values_list('alias', flat=True).first()
+    if alias is None:
+        alias = _unrecorded_shard(key, shards)
+        if not for_write:
+            return alias
+        try:
+            entry, _ = ConversationShard.objects.using(PRIMARY_DB).get_or_create(key=key, defaults={'alias': alias})
+            alias = entry.alias
+        except IntegrityError:
+            alias = ConversationShard.objects.using(PRIMARY_DB).get(key=key).alias
+    with _directory_lock:
+        _directory[key] = (alias, now)
+    return alias
+
+
+def forget(key):
+    with _directory_lock:
+        _directory.pop(key, None)
+
+
+def shard_for_message(message, for_write=False):
+    return shard_for_key(conversation_key(message), for_write=for_write)
+
+
+def messages_for(key):
+    """ Message queryset bound to the shard that holds conversation `key`. """
+    from .models import Message
+    return Message.objects.using(shard_for_key(key))
+
+
+# --- Ids ---
+# Message ids must stay unique across shards so a conversation can move between them.
+# When sharding is on, ids are time-ordered: milliseconds since ID_EPOCH_MS, then 6 bits
+# of node id and 6 bits of sequence. That keeps them increasing (cursors keep working),
+# far above any legacy auto-increment id, and below 2**53 so the browser reads them exactly.
+# Each process leases its own node id from MessageIdNode on the primary, so no two
+# running processes can mint the same id; the lease is renewed as ids are generated.
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+NODE_BITS = 6
+SEQUENCE_BITS = 6
+
+_id_lock = threading.Lock()
+_id_state = {'ms': 0, 'sequence': 0}
+_lease = {'node': None, 'owner': None, 'pid': None, 'renew_at': 0}
+
+
+def node_lease_seconds():
+    return getattr(settings, 'CHAT_NODE_LEASE_SECONDS', 600)
+
+
+def _lease_connection():
+    """
+    Returns (connection, dedicated, provisional). Node leases must commit on their own: if one
+    rode along in the caller's transaction and that rolled back, this process would keep using
+    a node id the table says is free. SQLite can't write from a second connection while the
+    caller holds the lock, so there the lease is taken in-transaction and confirmed again on
+    the next id generated outside one.
+    """
+    connection = connections[PRIMARY_DB]
+    if not connection.in_atomic_block:
+        return connection, False, False
+    if connection.vendor == 'sqlite':
+        return connection, False, True
+    return connections.create_connection(PRIMARY_DB), True, False
+
+
+def _lease_node_id():
+    """ Returns this process's node id, leasing or renewing it first when due. Call with _id_lock held. """
+    now = time.monotonic()
+    if _lease['node'] is not None and _lease['pid'] == os.getpid() and now < _lease['renew_at']:
+        return _lease['node']
+
+    from .models import MessageIdNode
+    lease_seconds = node_lease_seconds()
+    table = MessageIdNode._meta.db_table
+    connection, dedicated, provisional = _lease_connection()
+    renew_after = 0 if provisional else lease_seconds / 3
+    adapt = connection.ops.adapt_datetimefield_value
+    expires_at = adapt(timezone.now() + timedelta(seconds=lease_seconds))
+    try:
+        with connection.cursor() as cursor:
+            if _lease['node'] is not None and _lease['pid'] == os.getpid():
+                cursor.execute(f'UPDATE {table} SET expires_at = %s WHERE node = %s AND owner = %s',
+                               [expires_at, _lease['node'], _lease['owner']])
+                if cursor.rowcount == 1:
+                    _lease['renew_at'] = now + renew_after
+                    return _lease['node']
+            # First id in this process (or after a fork, or the lease was lost): take a free or expired node.
+            owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            cursor.execute(f'SELECT node FROM {table} WHERE owner = %s OR expires_at < %s ORDER BY expires_at',
+                           ['', adapt(timezone.now())])
+            for (node,) in cursor.fetchall():
+                cursor.execute(f'UPDATE {table} SET owner = %s, expires_at = %s '
+                               f'WHERE node = %s AND (owner = %s OR expires_at < %s)',
+                               [owner, expires_at, node, '', adapt(timezone.now())])
+                if cursor.rowcount == 1:
+                    _lease.update(node=node, owner=owner, pid=os.getpid(), renew_at=now + renew_after)
+                    return node
+    finally:
+        if dedicated:
+            connection.close()
+    raise RuntimeError(f'All {1 << NODE_BITS} message id nodes are leased; too many processes are writing messages.')
+
+
+@atexit.register
+def _release_node():
+    if _lease['node'] is None or _lease['pid'] != os.getpid():
+        return
+    from .models import MessageIdNode
+    try:
+        MessageIdNode.objects.using(PRIMARY_DB).filter(node=_lease['node'], owner=_lease['owner']).update(owner='', expires_at=None)
+    except Exception:
+        pass  # The lease simply expires.
+
+
+def next_message_id():
+    with _id_lock:
+        ms = int(time.time() * 1000) - ID_EPOCH_MS
+        if ms <= _id_state['ms']:
+            ms = _id_state['ms']
+            _id_state['sequence'] += 1
+            if _id_state['sequence'] >> SEQUENCE_BITS:
+                # Sequence exhausted for this millisecond; borrow the next one.
+                ms += 1
+                _id_state['sequence'] = 0
+        else:
+            _id_state['sequence'] = 0
+        _id_state['ms'] = ms
+        return (ms << (NODE_BITS + SEQUENCE_BITS)) | (_lease_node_id() << SEQUENCE_BITS) | _id_state['sequence']
+
+
+def assign_message_ids(messages):
+    """ For bulk_create paths, which bypass Message.save. """
+    if sharding_enabled():
+        for message in messages:
+            if message.pk is None:
+                message.pk = next_message_id()
+    return messages
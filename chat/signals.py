@@ -0,0 +1,131 @@
+from django.contrib.auth.models import User
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .bot_store import invalidate_listing
+from .models import Bot, Group, Channel, Message, ConversationShard, UserHandle, normalize_username
+from .sharding import PRIMARY_DB, channel_key, forget, group_key, message_shards, shard_for_key
+from .usernames import username_index
+
+
+def _adjust_bot_counts(counter, bot_ids, delta):
+    if bot_ids:
+        Bot.objects.filter(pk__in=bot_ids).update(**{counter: F(counter) + delta})
+        invalidate_listing()
+
+
+def _track_bots(sender, instance, action, reverse, pk_set, counter, **kwargs):
+    """ Keeps Bot.group_count / Bot.channel_count in step with Group.bots / Channel.bots. """
+    if action == 'pre_clear':
+        # pk_set is not provided for clears, so remember what is about to go.
+        if reverse:
+            instance._cleared_count = getattr(instance, counter.replace('_count', 's')).count()
+        else:
+            instance._cleared_bot_ids = list(instance.bots.values_list('pk', flat=True))
+        return
+    if action == 'pre_remove':
+        # pk_set holds whatever was passed to remove(), attached or not; keep only links that exist.
+        side = counter.replace('_count', '')
+        if reverse:
+            instance._removed_count = sender.objects.filter(bot_id=instance.pk, **{f'{side}_id__in': pk_set}).count()
+        else:
+            instance._removed_bot_ids = list(sender.objects.filter(**{f'{side}_id': instance.pk}, bot_id__in=pk_set)
+                                             .values_list('bot_id', flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    delta = 1 if action == 'post_add' else -1
+
+    if reverse:
+        # bot.groups.add(...): one bot, len(pk_set) groups.
+        if action == 'post_clear':
+            amount = getattr(instance, '_cleared_count', 0)
+        elif action == 'post_remove':
+            amount = getattr(instance, '_removed_count', 0)
+        else:
+            amount = len(pk_set or ())
+        if amount:
+            Bot.objects.filter(pk=instance.pk).update(**{counter: F(counter) + delta * amount})
+            invalidate_listing()
+    elif action == 'post_clear':
+        _adjust_bot_counts(counter, getattr(instance, '_cleared_bot_ids', []), delta)
+    elif action == 'post_remove':
+        _adjust_bot_counts(counter, getattr(instance, '_removed_bot_ids', []), delta)
+    else:
+        # add() only reports the links it actually created.
+        _adjust_bot_counts(counter, pk_set, delta)
+
+
+@receiver(m2m_changed, sender=Group.bots.through)
+def track_group_bots(sender, **kwargs):
+    _track_bots(sender, counter='group_count', **kwargs)
+
+
+@receiver(m2m_changed, sender=Channel.bots.through)
+def track_channel_bots(sender, **kwargs):
+    _track_bots(sender, counter='channel_count', **kwargs)
+
+
+@receiver(pre_delete, sender=Group)
+def release_group_bots(sender, instance, **kwargs):
+    # Cascading deletes drop the m2m rows without sending m2m_changed.
+    _adjust_bot_counts('group_count', list(instance.bots.values_list('pk', flat=True)), -1)
+
+
+@receiver(pre_delete, sender=Channel)
+def release_channel_bots(sender, instance, **kwargs):
+    _adjust_bot_counts('channel_count', list(instance.bots.values_list('pk', flat=True)), -1)
+
+
+@receiver(post_save, sender=Bot)
+@receiver(pre_delete, sender=Bot)
+def bot_listing_changed(sender, **kwargs):
+    invalidate_listing()
+
+
+# The ORM only cascades within one database; clear out messages that live on other shards.
+def _delete_remote_messages(aliases, **lookup):
+    for alias in aliases:
+        if alias != PRIMARY_DB:
+            Message.objects.using(alias).filter(**lookup).delete()
+
+
+@receiver(pre_delete, sender=Group)
+def delete_group_messages(sender, instance, **kwargs):
+    key = group_key(instance.pk)
+    _delete_remote_messages([shard_for_key(key)], recipient_group_id=instance.pk)
+    ConversationShard.objects.filter(key=key).delete()
+    forget(key)
+
+
+@receiver(pre_delete, sender=Channel)
+def delete_channel_messages(sender, instance, **kwargs):
+    key = channel_key(instance.pk)
+    _delete_remote_messages([shard_for_key(key)], recipient_channel_id=instance.pk)
+    ConversationShard.objects.filter(key=key).delete()
+    forget(key)
+
+
+@receiver(pre_delete, sender=User)
+def delete_user_messages(sender, instance, **kwargs):
+    for alias in message_shards():
+        if alias != PRIMARY_DB:
+            Message.objects.using(alias).filter(Q(sender=instance) | Q(recipient_user=instance)).delete()
+
+
+# Registrations (bot accounts included) and renames keep the handle row and the autocomplete index current.
+@receiver(post_save, sender=User)
+def sync_user_handle(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'username' not in update_fields:
+        return  # e.g. the last_login update on every sign-in
+    key = normalize_username(instance.username)
+    if created or not UserHandle.objects.filter(user=instance).update(key=key):
+        UserHandle.objects.create(user=instance, key=key)
+    username_index.add(instance)
+
+
+@receiver(post_delete, sender=User)
+def drop_user_handle(sender, instance, **kwargs):
+    username_index.remove(instance.pk)
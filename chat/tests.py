@@ -1,3 +1,910 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import group_commit, presence, sharding
+from .bot_store import get_listing_page
+from .management.commands.import_chat import deferred_indexes
+from .management.commands.rebalance_shards import Command as RebalanceCommand
+from .models import (
+    Bot, Channel, ConversationShard, Group, GroupMember, Message, MessageIdNode, ScheduledMessage, UserHandle,
+)
+from .scheduler import MessageScheduler, dispatch, release_stale_claims, scheduler_settings
+from .sharding import PRIMARY_DB
+from .usernames import UsernameIndex, get_user_by_username
+from .views import BATCH_MAX_REQUESTS
+
+try:
+    from PIL import Image
+except ImportError:  # attachments.py records no dimensions without Pillow
+    Image = None
+
+
+def other_shard(alias):
+    return next(shard for shard in sharding.message_shards() if shard != alias)
+
+
+@skipUnless(sharding.sharding_enabled(), 'needs two message shards: run with --settings=teleclone_backend.test_settings')
+class ShardingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        sharding._directory.clear()
+
+    def make_group(self, hashed_to=None):
+        """ A group of alice's whose key hashes to `hashed_to` (any shard if None). """
+        while True:
+            group = Group.objects.create(name='g', creator=self.alice)
+            if hashed_to is None or sharding.hashed_shard(sharding.group_key(group.id)) == hashed_to:
+                GroupMember.objects.create(group=group, user=self.alice)
+                return group
+
+    def send_to_group(self, group, count):
+        for i in range(count):
+            response = self.client.post('/send_message/', {'type': 'group', 'id': group.id, 'text': f'm{i}'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_conversation_is_kept_on_one_shard_and_read_back(self):
+        users = [User.objects.create_user(f'u{i}') for i in range(6)]
+        for user in users:
+            for i in range(3):
+                self.client.post('/send_message/', {'type': 'user', 'id': user.id, 'text': f'hi {i}'})
+
+        for user in users:
+            key = sharding.dm_key(self.alice.id, user.id)
+            alias = ConversationShard.objects.get(key=key).alias
+            self.assertEqual(Message.objects.using(alias).filter(recipient_user=user).count(), 3)
+            self.assertFalse(Message.objects.using(other_shard(alias)).filter(recipient_user=user).exists())
+            messages = self.client.get(f'/get_messages/?type=user&id={user.id}&limit=50').json()
+            self.assertEqual([m['text'] for m in messages], ['hi 0', 'hi 1', 'hi 2'])
+        self.assertEqual(len(self.client.get('/chat/').context['direct_message_users']), 6)
+
+    def test_message_ids_are_unique_and_increasing(self):
+        group = self.make_group()
+        self.send_to_group(group, 20)
+        ids = list(sharding.messages_for(sharding.group_key(group.id)).order_by('timestamp', 'id')
+                   .values_list('id', flat=True))
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_processes_lease_different_nodes(self):
+        sharding.next_message_id()
+        first = sharding._lease['node']
+        self.assertEqual(MessageIdNode.objects.get(node=first).owner, sharding._lease['owner'])
+
+        saved = dict(sharding._lease)
+        try:
+            with mock.patch.object(sharding.os, 'getpid', return_value=os.getpid() + 1):
+                sharding.next_message_id()
+                second = sharding._lease['node']
+        finally:
+            sharding._lease.update(saved)
+        self.assertNotEqual(first, second)
+        self.assertEqual(MessageIdNode.objects.exclude(owner='').count(), 2)
+
+    def test_unrecorded_history_stays_on_the_primary(self):
+        group = self.make_group(hashed_to=other_shard(PRIMARY_DB))
+        key = sharding.group_key(group.id)
+        Message(sender=self.alice, recipient_group=group, text='legacy').save(using=PRIMARY_DB)
+
+        self.send_to_group(group, 1)
+        self.assertEqual(ConversationShard.objects.get(key=key).alias, PRIMARY_DB)
+        self.assertEqual(Message.objects.using(PRIMARY_DB).filter(recipient_group=group).count(), 2)
+
+    def test_new_conversation_is_placed_by_hash(self):
+        target = other_shard(PRIMARY_DB)
+        group = self.make_group(hashed_to=target)
+        self.send_to_group(group, 1)
+        self.assertEqual(ConversationShard.objects.get(key=sharding.group_key(group.id)).alias, target)
+        self.assertEqual(Message.objects.using(target).filter(recipient_group=group).count(), 1)
+
+    def test_rebalance_moves_a_conversation(self):
+        group = self.make_group()
+        self.send_to_group(group, 5)
+        key = sharding.group_key(group.id)
+        source = sharding.shard_for_key(key)
+        target = other_shard(source)
+        ids = set(Message.objects.using(source).filter(recipient_group=group).values_list('id', flat=True))
+
+        call_command('rebalance_shards', keys=[key], target=target, settle=0, stdout=io.StringIO())
+        sharding.forget(key)
+
+        self.assertEqual(sharding.shard_for_key(key), target)
+        self.assertFalse(Message.objects.using(source).filter(recipient_group=group).exists())
+        self.assertEqual(set(Message.objects.using(target).filter(recipient_group=group).values_list('id', flat=True)), ids)
+        messages = self.client.get(f'/get_messages/?type=group&id={group.id}').json()
+        self.assertEqual([m['text'] for m in messages], [f'm{i}' for i in range(5)])
+
+    def test_rebalance_catches_up_rows_committed_below_the_copied_ids(self):
+        group = self.make_group()
+        self.send_to_group(group, 3)
+        key = sharding.group_key(group.id)
+        source = sharding.shard_for_key(key)
+        target = other_shard(source)
+        command = RebalanceCommand()
+        started = timezone.now()
+
+        command.copy(key, source, target, batch_size=2)
+        lowest = Message.objects.using(source).filter(recipient_group=group).order_by('id').first().id
+        Message(id=lowest - 1, sender=self.alice, recipient_group=group, text='late').save(using=source, force_insert=True)
+        command.finish(key, source, target, started, batch_size=2)
+
+        self.assertFalse(Message.objects.using(source).filter(recipient_group=group).exists())
+        self.assertEqual(Message.objects.using(target).filter(recipient_group=group).count(), 4)
+        self.assertTrue(Message.objects.using(target).filter(id=lowest - 1, text='late').exists())
+
+    def test_rebalance_stops_on_a_conflicting_id(self):
+        group = self.make_group()
+        self.send_to_group(group, 3)
+        key = sharding.group_key(group.id)
+        source = sharding.shard_for_key(key)
+        target = other_shard(source)
+        taken = Message.objects.using(source).filter(recipient_group=group).first()
+        Message(id=taken.id, sender=self.bob, recipient_user=self.alice, text='other').save(using=target, force_insert=True)
+
+        with self.assertRaises(CommandError):
+            call_command('rebalance_shards', keys=[key], target=target, settle=0, stdout=io.StringIO())
+
+        self.assertEqual(Message.objects.using(source).filter(recipient_group=group).count(), 3)
+        self.assertEqual(ConversationShard.objects.get(key=key).alias, source)
+        self.assertEqual(Message.objects.using(target).get(id=taken.id).text, 'other')
+
+
+class MessagePollTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        self.key = sharding.dm_key(self.alice.id, self.bob.id)
+
+    def send(self, **fields):
+        fields.setdefault('text', 'hi')
+        return Message.objects.create(sender=self.bob, recipient_user=self.alice, **fields)
+
+    def poll(self, after, **params):
+        return self.client.get('/get_messages/', {'type': 'user', 'id': self.bob.id, 'after': after, **params}).json()
+
+    def unread(self, **marker):
+        body = {'requests': [{'op': 'summary', 'type': 'user', 'id': self.bob.id, **marker}]}
+        response = self.client.post('/batch/', json.dumps(body), content_type='application/json')
+        return response.json()['responses'][0]['body']['unread']
+
+    def test_a_lower_id_committed_after_a_higher_one_was_read_is_still_delivered(self):
+        high = self.send(id=2000)
+        self.assertEqual([m['id'] for m in self.poll(0)], [high.id])
+
+        late = self.send(id=1000, text='late')
+        self.assertIn(late.id, [m['id'] for m in self.poll(high.id)])
+
+    def test_only_recent_rows_are_read_again(self):
+        old = self.send()
+        sharding.messages_for(self.key).filter(id=old.id).update(timestamp=timezone.now() - timedelta(hours=1))
+        new = self.send()
+        self.assertEqual([m['id'] for m in self.poll(new.id)], [new.id])
+
+    def test_since_echoed_back_does_not_repeat_the_newest_tombstone(self):
+        first, second = self.send(), self.send()
+        # Old enough to be outside the poll overlap, so only `since` can bring them back.
+        sharding.messages_for(self.key).update(timestamp=timezone.now() - timedelta(hours=1))
+        deleted_at = timezone.now().replace(microsecond=123456)
+        sharding.messages_for(self.key).filter(id=first.id).update(is_deleted=True, deleted_at=deleted_at)
+
+        changed = self.poll(second.id, since=(deleted_at - timedelta(minutes=1)).isoformat())
+        self.assertEqual([m['id'] for m in changed], [first.id])
+        since = changed[0]['deleted_at']  # as the client echoes it: milliseconds only
+        self.assertEqual(self.poll(second.id, since=since), [])
+
+        sharding.messages_for(self.key).filter(id=second.id).update(
+            is_deleted=True, deleted_at=deleted_at + timedelta(milliseconds=1))
+        self.assertEqual([m['id'] for m in self.poll(second.id, since=since)], [second.id])
+
+    def test_summary_counts_a_late_commit_under_the_seen_ids(self):
+        self.send(id=1000)
+        self.send(id=3000)
+        self.assertEqual(self.unread(after=1000, seen=[3000]), 0)
+
+        self.send(id=2000)
+        self.assertEqual(self.unread(after=1000, seen=[3000]), 1)
+        self.assertEqual(self.unread(after=1000, seen=[2000, 3000]), 0)
+
+
+class DeletedMessageTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        self.alias = sharding.shard_for_key(sharding.dm_key(self.alice.id, self.bob.id), for_write=True)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.storage = Message._meta.get_field('file').storage
+
+    def send(self, **fields):
+        return Message.objects.create(sender=self.alice, recipient_user=self.bob, **fields)
+
+    def tombstone(self, message, days_ago=60):
+        Message.objects.using(self.alias).filter(id=message.id).update(
+            is_deleted=True, deleted_at=timezone.now() - timedelta(days=days_ago), text=None)
+
+    def stored(self, name):
+        return self.storage.save(name, ContentFile(b'data'))
+
+    def purge(self, **options):
+        call_command('purge_deleted_messages', older_than_days=30, sleep=0, stdout=io.StringIO(), **options)
+
+    def test_deleted_messages_go_out_as_tombstones(self):
+        self.send(text='secret', file=self.stored('secret.txt'), file_size=4, file_content_type='text/plain',
+                  file_sha256='ab' * 32)
+        self.send(text='kept')
+        deleted = Message.objects.using(self.alias).get(text='secret')
+        self.assertEqual(self.client.post(f'/delete_message/{deleted.id}/').status_code, 200)
+
+        for params in ({}, {'limit': 10}, {'after': 0}):
+            messages = self.client.get('/get_messages/', {'type': 'user', 'id': self.bob.id, **params}).json()
+            tombstone, live = messages
+            self.assertTrue(tombstone['is_deleted'])
+            self.assertIsNone(tombstone['text'])
+            self.assertIsNone(tombstone['file'])
+            self.assertIsNone(tombstone['file_sha256'])
+            self.assertIsNone(tombstone['file_size'])
+            self.assertEqual((live['is_deleted'], live['text']), (False, 'kept'))
+
+    def test_purge_removes_old_tombstones_in_batches(self):
+        old = [self.send(text=f'old{i}') for i in range(5)]
+        recent, live = self.send(text='recent'), self.send(text='live')
+        for message in old:
+            self.tombstone(message)
+        self.tombstone(recent, days_ago=1)
+
+        self.purge(dry_run=True)
+        self.assertEqual(Message.objects.using(self.alias).count(), 7)
+
+        with CaptureQueriesContext(connections[self.alias]) as queries:
+            self.purge(batch_size=2)
+        deletes = [q for q in queries.captured_queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(set(Message.objects.using(self.alias).values_list('id', flat=True)), {recent.id, live.id})
+
+    def test_purge_never_releases_a_file_another_message_uses(self):
+        shared, own = self.stored('shared.txt'), self.stored('own.txt')
+        self.tombstone(self.send(file=shared))
+        self.send(file=shared)
+        self.tombstone(self.send(file=own))
+
+        self.purge(batch_size=1)
+
+        self.assertTrue(self.storage.exists(shared))
+        self.assertFalse(self.storage.exists(own))
+
+
+class BotCounterTests(TestCase):
+    SIDES = [(Group, 'groups', 'group_count'), (Channel, 'channels', 'channel_count')]
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.bots = [Bot.objects.create(owner=self.owner, user_account=User.objects.create_user(f'b{i}bot'))
+                     for i in range(3)]
+
+    def counts(self, counter):
+        return [Bot.objects.get(pk=bot.pk).__dict__[counter] for bot in self.bots]
+
+    def test_chat_side(self):
+        b0, b1, b2 = self.bots
+        for model, _, counter in self.SIDES:
+            with self.subTest(counter):
+                chat = model.objects.create(name='c', creator=self.owner)
+                chat.bots.add(b0, b1)
+                chat.bots.add(b0)
+                self.assertEqual(self.counts(counter), [1, 1, 0])
+                chat.bots.remove(b0)
+                chat.bots.remove(b0, b2)  # neither is attached any more
+                self.assertEqual(self.counts(counter), [0, 1, 0])
+                chat.bots.set([b1, b2])
+                self.assertEqual(self.counts(counter), [0, 1, 1])
+                chat.bots.clear()
+                self.assertEqual(self.counts(counter), [0, 0, 0])
+                chat.bots.add(b0, b2)
+                chat.delete()
+                self.assertEqual(self.counts(counter), [0, 0, 0])
+
+    def test_bot_side(self):
+        bot = self.bots[0]
+        for model, related, counter in self.SIDES:
+            with self.subTest(counter):
+                chats = [model.objects.create(name=f'c{i}', creator=self.owner) for i in range(3)]
+                chats_of = getattr(bot, related)
+                chats_of.add(chats[0], chats[1])
+                chats_of.add(chats[0])
+                self.assertEqual(self.counts(counter)[0], 2)
+                chats_of.remove(chats[0])
+                chats_of.remove(chats[0], chats[2])
+                self.assertEqual(self.counts(counter)[0], 1)
+                chats_of.set([chats[1], chats[2]])
+                self.assertEqual(self.counts(counter)[0], 2)
+                chats_of.clear()
+                self.assertEqual(self.counts(counter)[0], 0)
+                chats_of.add(chats[0])
+                chats[0].delete()
+                self.assertEqual(self.counts(counter)[0], 0)
+
+    def test_changes_invalidate_cached_listing_pages(self):
+        viewer = User.objects.create_user('viewer')
+        page = get_listing_page(viewer)
+        self.assertEqual([row['group_count'] for row in page['bots']], [0, 0, 0])
+
+        Group.objects.create(name='g', creator=self.owner).bots.add(self.bots[0])
+        page = get_listing_page(viewer)
+        self.assertEqual({row['id']: row['group_count'] for row in page['bots']}[self.bots[0].id], 1)
+
+        Bot.objects.create(owner=self.owner, user_account=User.objects.create_user('newbot'))
+        self.assertEqual(len(get_listing_page(viewer)['bots']), 4)
+
+
+class ImportTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.group = Group.objects.create(name='team', creator=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice)
+        for i in range(3):
+            Message.objects.create(sender=self.alice, recipient_user=self.bob, text=f'dm{i}')
+            Message.objects.create(sender=self.alice, recipient_group=self.group, text=f'group{i}')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'export.ndjson')
+
+    def all_texts(self):
+        return sorted(text for alias in sharding.message_shards()
+                      for text in Message.objects.using(alias).values_list('text', flat=True))
+
+    def export(self):
+        call_command('export_chat', user='alice', output=self.path)
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def write(self, records):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+
+    def load(self, **options):
+        out = io.StringIO()
+        call_command('import_chat', self.path, batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def clear_messages(self):
+        for alias in sharding.message_shards():
+            Message.objects.using(alias).all().delete()
+
+    def group_record(self, records, identity):
+        record = next(r for r in records if r['type'] == 'message' and r['recipient_group'])
+        return [records[0], {**record, 'recipient_group': identity}]
+
+    def test_round_trip_and_reimport_add_nothing(self):
+        before = self.all_texts()
+        self.export()
+        self.assertIn('Imported 0 messages; 6 were already present', self.load())
+
+        self.clear_messages()
+        self.assertIn('Imported 6 messages; 0 were already present', self.load())
+        self.assertEqual(self.all_texts(), before)
+        self.assertIn('Imported 0 messages; 6 were already present', self.load())
+        self.assertEqual(self.all_texts(), before)
+
+    def test_format_1_ids_need_same_database(self):
+        records = self.export()
+        self.clear_messages()
+        header, record = self.group_record(records, self.group.id)
+        self.write([{**header, 'version': 1}, record])
+
+        self.assertIn('and 1 belonged to groups or channels', self.load())
+        self.assertEqual(self.all_texts(), [])
+        self.assertIn('Imported 1 messages', self.load(same_database=True))
+        self.assertEqual(sharding.messages_for(sharding.group_key(self.group.id)).get().recipient_group_id, self.group.id)
+
+    def test_same_named_groups_are_told_apart_by_creation_time(self):
+        records = self.export()
+        twin = Group.objects.create(name='team', creator=self.alice)
+        Group.objects.filter(id=twin.id).update(created_at=timezone.now() - timedelta(days=1))
+        twin.refresh_from_db()
+        self.clear_messages()
+
+        identity = {'id': 999999, 'name': 'team', 'creator': 'alice', 'created_at': twin.created_at.isoformat()}
+        self.write(self.group_record(records, identity))
+        self.assertIn('Imported 1 messages', self.load())
+        self.assertTrue(sharding.messages_for(sharding.group_key(twin.id)).filter(recipient_group=twin).exists())
+
+    def test_unknown_chats_are_counted_not_imported(self):
+        records = self.export()
+        self.clear_messages()
+        identity = {'id': 999999, 'name': 'elsewhere', 'creator': 'alice', 'created_at': timezone.now().isoformat()}
+        header, record = self.group_record(records, identity)
+        stranger = {**record, 'id': record['id'] + 1, 'sender': 'nobody', 'recipient_group': None}
+        self.write([header, record, stranger])
+
+        output = self.load()
+        self.assertIn('Imported 0 messages; 0 were already present, 1 had unknown users and 1 belonged', output)
+        self.assertEqual(self.all_texts(), [])
+
+
+class DeferredIndexTests(TransactionTestCase):
+    databases = '__all__'
+    serialized_rollback = True  # see GroupCommitTests
+
+    def index_names(self, alias):
+        with connections[alias].cursor() as cursor:
+            return set(connections[alias].introspection.get_constraints(cursor, Message._meta.db_table))
+
+    def test_indexes_are_restored(self):
+        wanted = {index.name for index in Message._meta.indexes}
+        for alias in sharding.message_shards():
+            self.assertLessEqual(wanted, self.index_names(alias))
+
+        with deferred_indexes(True):
+            for alias in sharding.message_shards():
+                self.assertFalse(wanted & self.index_names(alias))
+        for alias in sharding.message_shards():
+            self.assertLessEqual(wanted, self.index_names(alias))
+
+    def test_indexes_are_restored_after_a_failed_load(self):
+        with self.assertRaises(CommandError):
+            call_command('import_chat', '/nonexistent.ndjson', defer_indexes=True)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'bad.ndjson')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"type": "header"}\nnot json\n')
+        with self.assertRaises(CommandError):
+            call_command('import_chat', path, defer_indexes=True, stdout=io.StringIO())
+
+        wanted = {index.name for index in Message._meta.indexes}
+        for alias in sharding.message_shards():
+            self.assertLessEqual(wanted, self.index_names(alias))
+
+
+class UsernameTests(TestCase):
+
+    def post(self, url, body):
+        return self.client.post(url, json.dumps(body), content_type='application/json')
+
+    def test_handle_follows_create_and_rename(self):
+        user = User.objects.create_user('Alice')
+        self.assertEqual(UserHandle.objects.get(user=user).key, 'alice')
+        user.username = 'Alicia'
+        user.save()
+        self.assertEqual(UserHandle.objects.get(user=user).key, 'alicia')
+        self.assertEqual(get_user_by_username('ALICIA'), user)
+        with self.assertRaises(User.DoesNotExist):
+            get_user_by_username('alice')
+
+    def test_login_ignores_case(self):
+        User.objects.create_user('Alice', password='secret')
+        self.assertEqual(self.post('/login/', {'username': 'aLICE', 'password': 'secret'}).status_code, 200)
+        self.assertEqual(self.post('/login/', {'username': 'alice', 'password': 'wrong'}).status_code, 400)
+
+    def test_names_differing_only_by_case_are_rejected(self):
+        User.objects.create_user('Bob')
+        response = self.post('/register/', {'username': 'bob', 'password': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+        owner = User.objects.create_user('owner')
+        self.client.force_login(owner)
+        self.assertEqual(self.post('/create_bot/', {'username': 'Alertbot'}).status_code, 200)
+        self.assertEqual(self.post('/create_bot/', {'username': 'ALERTBOT'}).status_code, 400)
+        self.assertEqual(User.objects.filter(username__iexact='alertbot').count(), 1)
+        self.assertEqual(self.client.get('/find_user/bOb/').json()['username'], 'Bob')
+
+    def test_prefix_search(self):
+        users = {name: User.objects.create_user(name) for name in ('Alice', 'alfred', 'Albert', 'bob')}
+        index = UsernameIndex()
+
+        self.assertEqual([u['username'] for u in index.search('AL')], ['Albert', 'alfred', 'Alice'])
+        self.assertEqual([u['username'] for u in index.search('al', limit=2)], ['Albert', 'alfred'])
+        self.assertEqual([u['username'] for u in index.search('al', exclude_ids={users['alfred'].id})],
+                         ['Albert', 'Alice'])
+        self.assertEqual(index.search('  '), [])
+        self.assertEqual(index.search('z'), [])
+
+        index.add(User.objects.create_user('Alvin'))
+        index.remove(users['Alice'].id)
+        self.assertEqual([u['username'] for u in index.search('al')], ['Albert', 'alfred', 'Alvin'])
+
+
+class AttachmentMetadataTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.messages = sharding.messages_for(sharding.dm_key(self.alice.id, self.bob.id))
+
+    def upload(self, name, content, content_type):
+        response = self.client.post('/send_message/', {
+            'type': 'user', 'id': self.bob.id, 'text': '', 'file': SimpleUploadedFile(name, content, content_type),
+        })
+        self.assertEqual(response.status_code, 200)
+        return self.messages.get(id=response.json()['id'])
+
+    @skipUnless(Image, 'image dimensions need Pillow')
+    def test_image_upload_records_metadata(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (30, 20)).save(buffer, 'PNG')
+        content = buffer.getvalue()
+
+        message = self.upload('photo.png', content, 'image/png')
+        self.assertEqual((message.file_size, message.file_content_type, message.file_sha256),
+                         (len(content), 'image/png', hashlib.sha256(content).hexdigest()))
+        self.assertEqual((message.image_width, message.image_height), (30, 20))
+
+        listed = self.client.get('/get_messages/', {'type': 'user', 'id': self.bob.id}).json()[0]
+        self.assertEqual((listed['file_size'], listed['image_width'], listed['image_height']), (len(content), 30, 20))
+
+    def test_other_upload_records_metadata_without_dimensions(self):
+        message = self.upload('notes.txt', b'hello', 'application/octet-stream')
+        self.assertEqual((message.file_size, message.file_content_type, message.file_sha256),
+                         (5, 'text/plain', hashlib.sha256(b'hello').hexdigest()))
+        self.assertEqual((message.image_width, message.image_height), (None, None))
+
+    def test_backfill_fills_missing_metadata_and_counts_missing_files(self):
+        present = self.upload('notes.txt', b'hello', 'text/plain')
+        lost = self.upload('gone.txt', b'bye', 'text/plain')
+        described = self.upload('kept.txt', b'kept', 'text/plain')
+        self.messages.filter(id__in=[present.id, lost.id]).update(
+            file_size=None, file_content_type='', file_sha256='', image_width=None, image_height=None)
+        Message._meta.get_field('file').storage.delete(lost.file.name)
+
+        out = io.StringIO()
+        call_command('backfill_attachment_metadata', sleep=0, stdout=out)
+
+        self.assertIn('Recorded metadata for 1 attachments; 1 files missing from storage.', out.getvalue())
+        present.refresh_from_db()
+        self.assertEqual((present.file_size, present.file_content_type, present.file_sha256),
+                         (5, 'text/plain', hashlib.sha256(b'hello').hexdigest()))
+        self.assertIsNone(self.messages.get(id=lost.id).file_size)
+        self.assertEqual(self.messages.get(id=described.id).file_sha256, hashlib.sha256(b'kept').hexdigest())
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        self.backend = presence.InMemoryPresenceBackend(presence.presence_settings())
+        self.enterContext(mock.patch.object(presence, '_backend', self.backend))
+        self.now = 1000.0
+        self.enterContext(mock.patch.object(presence.time, 'monotonic', lambda: self.now))
+
+    def typing(self, **data):
+        return self.client.post('/typing/', json.dumps(data), content_type='application/json')
+
+    def test_touch_is_coalesced_inside_the_window(self):
+        self.assertTrue(self.backend.touch('k', 60))
+        self.now += self.backend.coalesce - 0.5
+        self.assertFalse(self.backend.touch('k', 60))
+        self.now += 1
+        self.assertTrue(self.backend.touch('k', 60))
+
+    def test_keys_expire_after_their_ttl(self):
+        self.backend.touch('short', 5)
+        self.backend.touch('long', 60)
+        self.now += 5
+        self.assertEqual(self.backend.alive(['short', 'long', 'never']), {'long'})
+        # A key that expired inside the coalescing window is refreshed at once.
+        self.backend.touch('short', 1)
+        self.now += 1.5
+        self.assertEqual(self.backend.alive(['short']), set())
+        self.assertTrue(self.backend.touch('short', 1))
+        self.assertEqual(self.backend.alive(['short']), {'short'})
+
+    def test_typing_to_a_missing_user_is_a_404(self):
+        self.assertEqual(self.typing(type='user', id=999999).status_code, 404)
+        self.assertEqual(self.backend._expires, {})
+
+    def test_typing_to_a_user_shows_up_on_their_side(self):
+        self.assertEqual(self.typing(type='user', id=str(self.bob.id)).status_code, 200)
+        self.client.force_login(self.bob)
+        response = self.client.get('/presence/', {'type': 'user', 'id': self.alice.id})
+        self.assertEqual(response.json(), {'online': ['alice'], 'typing': ['alice']})
+
+
+class BatchTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+
+    def batch(self, *requests):
+        response = self.client.post('/batch/', json.dumps({'requests': list(requests)}), content_type='application/json')
+        return response
+
+    def statuses(self, *requests):
+        return [r['status'] for r in self.batch(*requests).json()['responses']]
+
+    def test_malformed_since_only_fails_its_sub_request(self):
+        statuses = self.statuses(
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'after': 0, 'since': 123},
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'after': 0, 'since': 'yesterday'},
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'after': 0, 'since': '2025-01-01T00:00:00Z'},
+        )
+        self.assertEqual(statuses, [400, 400, 200])
+
+    def test_each_sub_request_gets_its_own_status(self):
+        group = Group.objects.create(name='mine', creator=self.alice)
+        GroupMember.objects.create(group=group, user=self.alice)
+        GroupMember.objects.create(group=group, user=self.bob)
+        other = Group.objects.create(name='theirs', creator=self.bob)
+        for i in range(3):
+            self.client.post('/send_message/', {'type': 'group', 'id': group.id, 'text': f'm{i}'})
+
+        responses = self.batch(
+            {'op': 'messages', 'type': 'group', 'id': group.id, 'limit': 2},
+            {'op': 'members', 'type': 'group', 'id': str(group.id)},
+            {'op': 'summary', 'type': 'group', 'id': group.id},
+            {'op': 'messages', 'type': 'group', 'id': other.id},
+            {'op': 'members', 'type': 'group', 'id': other.id},
+            {'op': 'messages', 'type': 'user', 'id': 999999},
+            {'op': 'messages', 'type': 'planet', 'id': 1},
+            {'op': 'nope'},
+            'not an object',
+        ).json()['responses']
+
+        self.assertEqual([r['status'] for r in responses], [200, 200, 200, 403, 403, 404, 400, 400, 400])
+        self.assertEqual([m['text'] for m in responses[0]['body']], ['m1', 'm2'])
+        self.assertEqual(responses[1]['body'], [{'id': self.bob.id, 'username': 'bob'}])
+        self.assertEqual(responses[2]['body']['latest']['text'], 'm2')
+        self.assertEqual(responses[7]['error'], 'Unknown op.')
+
+    def test_malformed_pagination_is_a_400(self):
+        statuses = self.statuses(
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'after': 'x'},
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'limit': [1]},
+            {'op': 'summary', 'type': 'user', 'id': self.bob.id, 'before': {}},
+            {'op': 'summary', 'type': 'user', 'id': self.bob.id, 'after': 0, 'seen': ['1']},
+            {'op': 'summary', 'type': 'user', 'id': self.bob.id, 'after': 0, 'seen': 5},
+            {'op': 'messages', 'type': 'user', 'id': self.bob.id, 'after': '0', 'limit': '10'},
+        )
+        self.assertEqual(statuses, [400, 400, 400, 400, 400, 200])
+
+    def test_request_count_is_limited(self):
+        sub = {'op': 'summary', 'type': 'user', 'id': self.bob.id}
+        self.assertEqual(self.batch(*[sub] * BATCH_MAX_REQUESTS).status_code, 200)
+        self.assertEqual(self.batch(*[sub] * (BATCH_MAX_REQUESTS + 1)).status_code, 400)
+
+    def test_malformed_body_is_a_400(self):
+        for body in ('not json', '[]', '{"requests": {}}'):
+            response = self.client.post('/batch/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+
+
+class SchedulerTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.group = Group.objects.create(name='g', creator=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice)
+        self.client.force_login(self.alice)
+        sharding._directory.clear()
+
+    def schedule(self, send_at=None, **fields):
+        fields.setdefault('recipient_user', self.bob)
+        fields.setdefault('text', 'later')
+        return ScheduledMessage.objects.create(
+            sender=self.alice, send_at=send_at or timezone.now() - timedelta(seconds=1), **fields)
+
+    def pin_dm(self, alias):
+        """ Places the alice-bob conversation on `alias`, so dispatch takes that shard's path. """
+        if sharding.sharding_enabled():
+            ConversationShard.objects.create(key=sharding.dm_key(self.alice.id, self.bob.id), alias=alias)
+
+    def test_send_at_schedules_instead_of_sending(self):
+        send_at = (timezone.now() + timedelta(minutes=1)).isoformat()
+        response = self.client.post('/send_message/', {'type': 'user', 'id': self.bob.id, 'text': 'hi', 'send_at': send_at})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/send_message/', {'type': 'user', 'id': self.bob.id, 'text': 'hi',
+                                                       'send_at': '2000-01-01T00:00:00Z'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+        pending = self.client.get('/scheduled_messages/').json()
+        self.assertEqual([row['text'] for row in pending], ['hi'])
+        self.client.post(f"/scheduled_messages/{pending[0]['id']}/cancel/")
+        self.assertEqual(self.client.get('/scheduled_messages/').json(), [])
+
+    def test_dispatch_sends_each_row_once(self):
+        direct = self.schedule()
+        grouped = self.schedule(recipient_user=None, recipient_group=self.group, text='to group')
+
+        self.assertEqual(dispatch([direct.id, grouped.id]), 2)
+        self.assertEqual(dispatch([direct.id, grouped.id]), 0)
+
+        for row in (direct, grouped):
+            row.refresh_from_db()
+            self.assertEqual(row.status, ScheduledMessage.SENT)
+            message = sharding.messages_for(sharding.conversation_key(row)).get(id=row.message_id)
+            self.assertEqual(message.text, row.text)
+
+    def test_dispatch_skips_rows_not_yet_due_or_claimed_elsewhere(self):
+        future = self.schedule(send_at=timezone.now() + timedelta(minutes=1))
+        claimed = self.schedule()
+        ScheduledMessage.objects.filter(id=claimed.id).update(
+            status=ScheduledMessage.SENDING, claim_token='other', claimed_at=timezone.now())
+
+        self.assertEqual(dispatch([future.id, claimed.id]), 0)
+        self.assertFalse(Message.objects.exists())
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.claim_token, 'other')
+
+    def test_dispatch_fails_rows_whose_sender_left(self):
+        row = self.schedule(recipient_user=None, recipient_group=self.group)
+        GroupMember.objects.filter(user=self.alice).delete()
+
+        self.assertEqual(dispatch([row.id]), 0)
+        row.refresh_from_db()
+        self.assertEqual(row.status, ScheduledMessage.FAILED)
+
+    def test_failed_insert_hands_rows_back(self):
+        self.pin_dm(PRIMARY_DB)
+        row = self.schedule()
+        retried = []
+
+        with mock.patch('chat.scheduler._insert', side_effect=DatabaseError), \
+                self.assertLogs('chat.scheduler', 'ERROR'):
+            self.assertEqual(dispatch([row.id], retry=retried.extend), 0)
+
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.message_id, row.claim_token), (ScheduledMessage.PENDING, None, ''))
+        self.assertEqual(retried, [row.id])
+        self.assertFalse(Message.objects.exists())
+
+    @skipUnless(sharding.sharding_enabled(), 'needs two message shards')
+    def test_failed_insert_on_another_shard_is_settled_by_the_lease(self):
+        self.pin_dm(other_shard(PRIMARY_DB))
+        row = self.schedule()
+        retried = []
+
+        with mock.patch('chat.scheduler._insert', side_effect=DatabaseError), \
+                self.assertLogs('chat.scheduler', 'ERROR'):
+            self.assertEqual(dispatch([row.id], retry=retried.extend), 0)
+        row.refresh_from_db()
+        # The insert may have committed before failing, so the row waits for the lease.
+        self.assertEqual(retried, [])
+        self.assertEqual(row.status, ScheduledMessage.SENDING)
+        self.assertIsNotNone(row.message_id)
+
+        self.assertEqual(release_stale_claims(lease=0), [row.id])
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.message_id), (ScheduledMessage.PENDING, None))
+
+    def test_stale_claims_are_settled_by_whether_the_message_exists(self):
+        self.pin_dm(PRIMARY_DB)
+        delivered = Message.objects.create(sender=self.alice, recipient_user=self.bob, text='made it')
+        old = timezone.now() - timedelta(minutes=10)
+        lost, sent, fresh = self.schedule(), self.schedule(), self.schedule()
+        ScheduledMessage.objects.filter(id=lost.id).update(status=ScheduledMessage.SENDING, claimed_at=old)
+        ScheduledMessage.objects.filter(id=sent.id).update(
+            status=ScheduledMessage.SENDING, claimed_at=old, message_id=delivered.id)
+        ScheduledMessage.objects.filter(id=fresh.id).update(status=ScheduledMessage.SENDING, claimed_at=timezone.now())
+
+        self.assertEqual(release_stale_claims(lease=60), [lost.id])
+        statuses = dict(ScheduledMessage.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {lost.id: ScheduledMessage.PENDING, sent.id: ScheduledMessage.SENT,
+                                    fresh.id: ScheduledMessage.SENDING})
+
+    def test_refill_picks_up_new_rows_without_a_full_reload(self):
+        scheduler = MessageScheduler(scheduler_settings())
+        due = self.schedule()
+        beyond = self.schedule(send_at=timezone.now() + timedelta(seconds=scheduler.horizon * 2))
+        scheduler.refill()
+        self.assertEqual(scheduler.take_due(time.time()), [due.id])
+
+        added = self.schedule()
+        with mock.patch.object(scheduler, 'resync') as resync:
+            scheduler.refill()
+        resync.assert_not_called()
+        self.assertEqual(scheduler.take_due(time.time()), [added.id])
+        self.assertNotIn(beyond.id, scheduler._queued)
+
+
+@override_settings(CHAT_GROUP_COMMIT={'ENABLED': True, 'WINDOW_MS': 2000, 'MAX_BATCH': 8})
+class GroupCommitTests(TransactionTestCase):
+    databases = '__all__'
+    serialized_rollback = True  # the flush would drop the message id nodes created by migration 0008
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        # Record the placement up front: the in-memory test database can't take concurrent directory writes.
+        self.alias = sharding.shard_for_key(sharding.dm_key(self.alice.id, self.bob.id), for_write=True)
+        group_commit._committer = None
+        self.addCleanup(setattr, group_commit, '_committer', None)
+        self.batches = []
+        insert = group_commit.GroupCommitter._insert
+
+        def spy(committer, alias, messages):
+            self.batches.append(len(messages))
+            return insert(committer, alias, messages)
+        patcher = mock.patch.object(group_commit.GroupCommitter, '_insert', spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_concurrently(self, fields):
+        """ Sends one message per entry of `fields` from its own thread; returns each Message or exception. """
+        results = [None] * len(fields)
+
+        def send(i):
+            try:
+                results[i] = group_commit.create_message(sender=self.alice, recipient_user=self.bob, **fields[i])
+            except Exception as e:
+                results[i] = e
+            finally:
+                connections.close_all()
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(len(fields))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_sends_share_one_insert(self):
+        results = self.send_concurrently([{'text': f't{i}'} for i in range(8)])
+
+        self.assertTrue(all(isinstance(message, Message) for message in results), results)
+        self.assertEqual(self.batches, [8])
+        stored = dict(sharding.messages_for(sharding.dm_key(self.alice.id, self.bob.id)).values_list('id', 'text'))
+        self.assertEqual({message.id: message.text for message in results}, stored)
+        self.assertEqual(len(stored), 8)
+
+    def test_a_failing_row_only_fails_its_sender(self):
+        taken = Message.objects.create(sender=self.alice, recipient_user=self.bob, text='first').id
+        fields = [{'text': f't{i}'} for i in range(8)]
+        fields[3]['id'] = taken
+
+        results = self.send_concurrently(fields)
+
+        self.assertEqual(self.batches, [8])
+        self.assertIsInstance(results[3], IntegrityError)
+        self.assertTrue(all(isinstance(results[i], Message) for i in range(8) if i != 3))
+        texts = sharding.messages_for(sharding.dm_key(self.alice.id, self.bob.id)).values_list('text', flat=True)
+        self.assertEqual(sorted(texts), sorted(['first'] + [f't{i}' for i in range(8) if i != 3]))
+
+    def test_sends_inside_a_transaction_are_not_batched(self):
+        with self.assertRaises(RuntimeError), transaction.atomic(using=self.alias):
+            group_commit.create_message(sender=self.alice, recipient_user=self.bob, text='rolled back')
+            raise RuntimeError
+
+        self.assertEqual(self.batches, [])
+        self.assertFalse(Message.objects.using(self.alias).exists())
@@ -16,6 +16,7 @@ urlpatterns = [
 
     # API-like views
     path('find_user/<str:username>/', views.find_user, name='find_user'),
+    path('users/autocomplete/', views.autocomplete_users, name='autocomplete_users'),
     path('get_item_members/<int:item_id>/', views.get_item_members, name='get_item_members'),
     path('create_bot/', views.create_bot, name='create_bot'),
     path('bots/<int:bot_id>/scripts/', views.get_bot_scripts, name='get_bot_scripts'),
@@ -29,4 +30,11 @@ urlpatterns = [
     path('get_messages/', views.get_messages, name='get_messages'),
     path('send_message/', views.send_message, name='send_message'),
     path('delete_message/<int:message_id>/', views.delete_message, name='delete_message'),
+    path('scheduled_messages/', views.scheduled_messages, name='scheduled_messages'),
+    path('scheduled_messages/<int:scheduled_id>/cancel/', views.cancel_scheduled_message, name='cancel_scheduled_message'),
+    path('batch/', views.batch, name='batch'),
+    path('export/', views.export_messages, name='export_messages'),
+    path('presence/', views.get_presence, name='get_presence'),
+    path('presence/heartbeat/', views.presence_heartbeat, name='presence_heartbeat'),
+    path('typing/', views.typing, name='typing'),
 ]
\ No newline at end of file
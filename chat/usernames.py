@@ -0,0 +1,108 @@
+""" Case-insensitive username lookup and an in-process prefix index for autocomplete. """
+import bisect
+import threading
+import time
+
+from django.contrib.auth.models import User
+
+from .models import UserHandle, normalize_username
+
+AUTOCOMPLETE_LIMIT = 10
+# New registrations made by other worker processes are picked up this often...
+CATCH_UP_INTERVAL = 5
+# ...and renames/deletions made elsewhere by a full reload this often.
+RELOAD_INTERVAL = 600
+
+
+def get_user_by_username(username):
+    """ Resolves a username case-insensitively through the indexed handle key. Raises User.DoesNotExist. """
+    users = list(User.objects.filter(handle__key=normalize_username(username or ''))[:2])
+    if len(users) == 1:
+        return users[0]
+    # Accounts that differ only by case predate the handle table; only an exact match is unambiguous then.
+    for user in users:
+        if user.username == username:
+            return user
+    raise User.DoesNotExist
+
+
+def username_taken(username):
+    """ True if an account already uses this name in any capitalisation; new accounts must not. """
+    return UserHandle.objects.filter(key=normalize_username(username or '')).exists()
+
+
+class UsernameIndex:
+    """
+    Every username kept as a sorted list of (key, user_id, username), so a prefix
+    search is a bisect plus a short scan. Updated in place by the User signals.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._keys = {}  # user_id -> key currently in _entries
+        self._max_id = 0
+        self._loaded_at = None
+        self._caught_up_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        rows = UserHandle.objects.order_by('key', 'user_id').values_list('key', 'user_id', 'user__username')
+        self._entries = list(rows)
+        self._keys = {user_id: key for key, user_id, _ in self._entries}
+        self._max_id = max(self._keys, default=0)
+        self._loaded_at = self._caught_up_at = time.monotonic()
+
+    def _catch_up(self):
+        rows = UserHandle.objects.filter(user_id__gt=self._max_id).values_list('key', 'user_id', 'user__username')
+        for key, user_id, username in rows:
+            self._insert(key, user_id, username)
+        self._caught_up_at = time.monotonic()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at > RELOAD_INTERVAL:
+            self._load()
+        elif now - self._caught_up_at > CATCH_UP_INTERVAL:
+            self._catch_up()
+
+    def _insert(self, key, user_id, username):
+        self._discard(user_id)
+        bisect.insort(self._entries, (key, user_id, username))
+        self._keys[user_id] = key
+        self._max_id = max(self._max_id, user_id)
+
+    def _discard(self, user_id):
+        key = self._keys.pop(user_id, None)
+        if key is None:
+            return
+        i = bisect.bisect_left(self._entries, (key, user_id))
+        if i < len(self._entries) and self._entries[i][1] == user_id:
+            del self._entries[i]
+
+    def add(self, user):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._insert(normalize_username(user.username), user.id, user.username)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def search(self, prefix, limit=AUTOCOMPLETE_LIMIT, exclude_ids=()):
+        prefix = normalize_username(prefix.strip())
+        if not prefix:
+            return []
+        with self._lock:
+            self._refresh()
+            matches = []
+            for key, user_id, username in self._entries[bisect.bisect_left(self._entries, (prefix,)):]:
+                if not key.startswith(prefix):
+                    break
+                if user_id not in exclude_ids:
+                    matches.append({'id': user_id, 'username': username})
+                    if len(matches) >= limit:
+                        break
+            return matches
+
+
+username_index = UsernameIndex()
@@ -2,14 +2,25 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponseBadRequest
+from django.http import Http404, JsonResponse, HttpResponseForbidden, HttpResponseBadRequest, StreamingHttpResponse
 from django.views.decorators.http import require_POST
-from django.db.models import Q
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
+import heapq
 import json
 import secrets
-from .models import Group, Channel, Message, Contact, GroupMember, ChannelMember, Bot, BotScript
+from .models import Group, Channel, Message, Contact, GroupMember, ChannelMember, Bot, BotScript, ScheduledMessage
+from .attachments import ATTACHMENT_FIELDS, describe_upload
+from .bot_store import get_listing_page
+from .export import dm_messages, user_messages, iter_records, iter_ndjson
+from .group_commit import create_message
+from .sharding import message_shards, messages_for, key_for, group_key, channel_key
+from .presence import get_presence_backend, presence_settings, online_key, typing_key
+from .scheduler import notify_scheduled
+from .usernames import AUTOCOMPLETE_LIMIT, get_user_by_username, username_index, username_taken
 
 
 # --- Auth Views (Unchanged) ---
@@ -21,7 +32,13 @@ def landing_page(request):
 def login_view(request):
     if request.method == 'POST':
         data = json.loads(request.body)
-        user = authenticate(request, username=data.get('username'), password=data.get('password'))
+        username = data.get('username')
+        try:
+            # Sign in with any capitalisation of the username, as every other lookup allows.
+            username = get_user_by_username(username).username
+        except User.DoesNotExist:
+            pass
+        user = authenticate(request, username=username, password=data.get('password'))
         if user:
             login(request, user)
             return JsonResponse({'success': True})
@@ -32,6 +49,9 @@ def login_view(request):
 def register_view(request):
     if request.method == 'POST':
         data = json.loads(request.body)
+        # "Bob" next to "bob" would make both unreachable by case-insensitive lookup.
+        if username_taken(data.get('username')):
+            return JsonResponse({'error': 'This username is already taken.'}, status=400)
         try:
             user = User.objects.create_user(username=data.get('username'), password=data.get('password'))
             login(request, user)
@@ -51,9 +71,14 @@ def logout_view(request):
 @login_required
 def chat_index(request):
     contact_users = User.objects.filter(contact_of__user=request.user)
-    message_users = User.objects.filter(
-        Q(sent_messages__recipient_user=request.user) | Q(received_messages__sender=request.user)
-    ).distinct()
+    # Messages may sit on other databases than users, so collect DM partner ids shard by shard.
+    partner_ids = set()
+    for alias in message_shards():
+        shard_messages = Message.objects.using(alias)
+        partner_ids.update(shard_messages.filter(recipient_user=request.user).values_list('sender_id', flat=True).distinct())
+        partner_ids.update(shard_messages.filter(sender=request.user, recipient_user__isnull=False)
+                           .values_list('recipient_user_id', flat=True).distinct())
+    message_users = User.objects.filter(id__in=partner_ids)
     combined_users = list(set(list(contact_users) + list(message_users)))
     direct_message_users = [user for user in combined_users if user.id != request.user.id]
 
@@ -66,6 +91,7 @@ def chat_index(request):
         'groups': groups,
         'channels': channels,
         'bots': bots,
+        'poll_overlap_ms': POLL_OVERLAP_SECONDS * 1000,
     }
     return render(request, 'chat/index.html', context)
 
@@ -79,8 +105,14 @@ def bot_management_view(request):
 
 @login_required
 def bot_store_view(request):
-    all_bots = Bot.objects.exclude(owner=request.user)
-    return render(request, 'chat/bot_store.html', {'all_bots': all_bots})
+    query = request.GET.get('q', '')
+    cursor = request.GET.get('cursor')
+    page = get_listing_page(request.user, prefix=query, cursor=int(cursor) if cursor and cursor.isdigit() else None)
+    return render(request, 'chat/bot_store.html', {
+        'all_bots': page['bots'],
+        'next_cursor': page['next_cursor'],
+        'query': query,
+    })
 
 
 @login_required
@@ -92,6 +124,8 @@ def create_bot(request):
         return JsonResponse({'error': 'Bot username is required.'}, status=400)
     if not username.lower().endswith('bot'):
         return JsonResponse({'error': 'Bot username must end with "bot".'}, status=400)
+    if username_taken(username):
+        return JsonResponse({'error': 'This username is already taken.'}, status=400)
 
     try:
         bot_user = User.objects.create_user(username=username, password=secrets.token_hex(16))
@@ -153,7 +187,7 @@ def add_contact(request):
     data = json.loads(request.body)
     username_to_add = data.get('username')
     try:
-        contact_user_to_add = User.objects.get(username__iexact=username_to_add)
+        contact_user_to_add = get_user_by_username(username_to_add)
         if contact_user_to_add == request.user:
             return JsonResponse({"error": "You cannot add yourself."}, status=400)
 
@@ -201,7 +235,7 @@ def add_member(request, item_id):
     type = data.get('type')
 
     try:
-        user_to_add = User.objects.get(username__iexact=username_to_add)
+        user_to_add = get_user_by_username(username_to_add)
         if type == 'group':
             item = get_object_or_404(Group, id=item_id)
             if not GroupMember.objects.filter(group=item, user=request.user, can_add_users=True).exists():
@@ -304,7 +338,7 @@ def execute_bot_logic(message):
                 else:  # Group
                     reply_data['recipient_group'] = recipient
 
-                Message.objects.create(**reply_data)
+                create_message(**reply_data)
                 break
 
 
@@ -320,6 +354,8 @@ def send_message(request):
         return JsonResponse({'error': 'Message must have text or a file.'}, status=400)
 
     message_data = {'sender': request.user, 'text': text, 'file': file}
+    if file:
+        message_data.update(describe_upload(file))
 
     if recipient_type == 'user':
         message_data['recipient_user'] = get_object_or_404(User, id=recipient_id)
@@ -336,18 +372,68 @@ def send_message(request):
     else:
         return HttpResponseBadRequest("Invalid recipient type.")
 
-    new_message = Message.objects.create(**message_data)
+    if request.POST.get('send_at'):
+        return _schedule_message(message_data, request.POST['send_at'])
+
+    new_message = create_message(**message_data)
+    get_presence_backend().clear(typing_key(recipient_type, recipient_id, request.user.id))
 
     if new_message.text:
         execute_bot_logic(new_message)
 
+    return JsonResponse({'success': True, 'id': new_message.id})
+
+
+def _schedule_message(message_data, send_at_value):
+    send_at = parse_datetime(send_at_value)
+    if send_at is None:
+        return JsonResponse({'error': 'send_at must be an ISO 8601 date and time.'}, status=400)
+    if timezone.is_naive(send_at):
+        send_at = timezone.make_aware(send_at)
+    if send_at <= timezone.now():
+        return JsonResponse({'error': 'send_at must be in the future.'}, status=400)
+
+    scheduled = ScheduledMessage.objects.create(send_at=send_at, **message_data)
+    transaction.on_commit(lambda: notify_scheduled(scheduled))
+    return JsonResponse({'success': True, 'scheduled': {'id': scheduled.id, 'send_at': scheduled.send_at}})
+
+
+@login_required
+def scheduled_messages(request):
+    """ The caller's messages still waiting to be sent, soonest first. """
+    pending = ScheduledMessage.objects.filter(sender=request.user, status=ScheduledMessage.PENDING).order_by('send_at')
+    return JsonResponse(list(pending.values(
+        'id', 'send_at', 'text', 'file', 'recipient_user_id', 'recipient_group_id', 'recipient_channel_id',
+    )), safe=False)
+
+
+@login_required
+@require_POST
+def cancel_scheduled_message(request, scheduled_id):
+    cancelled = ScheduledMessage.objects.filter(
+        id=scheduled_id, sender=request.user, status=ScheduledMessage.PENDING,
+    ).update(status=ScheduledMessage.CANCELLED)
+    if not cancelled:
+        return JsonResponse({'error': 'No pending scheduled message with that id.'}, status=404)
     return JsonResponse({'success': True})
 
 
 @login_required
 @require_POST
 def delete_message(request, message_id):
-    message = get_object_or_404(Message, id=message_id)
+    data = json.loads(request.body) if request.content_type == 'application/json' and request.body else {}
+    if data.get('type') and data.get('id'):
+        # The client names the conversation, so only its shard is touched.
+        try:
+            key = key_for(data['type'], data['id'], request.user.id)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid recipient type.")
+        message = get_object_or_404(messages_for(key), id=message_id)
+    else:
+        message = next((m for alias in message_shards()
+                        for m in Message.objects.using(alias).filter(id=message_id)), None)
+        if message is None:
+            raise Http404("No Message matches the given query.")
     can_delete = False
     if message.sender == request.user:
         can_delete = True
@@ -363,8 +449,11 @@ def delete_message(request, message_id):
     if not can_delete:
         return HttpResponseForbidden("You don't have permission to delete this message.")
 
+    # Compact the row down to a tombstone; the attachment itself is released by purge_deleted_messages.
     message.is_deleted = True
-    message.save()
+    message.deleted_at = timezone.now()
+    message.text = None
+    message.save(update_fields=['is_deleted', 'deleted_at', 'text'])
     return JsonResponse({"success": True})
 @login_required
 def get_messages(request):
@@ -374,33 +463,364 @@ def get_messages(request):
 
     if recipient_type == 'user':
         other_user = get_object_or_404(User, id=recipient_id)
-        messages = Message.objects.filter(
-            (Q(sender=request.user) & Q(recipient_user=other_user)) |
-            (Q(sender=other_user) & Q(recipient_user=request.user))
-        )
+        messages = dm_messages(request.user, other_user)
     elif recipient_type == 'group':
         group = get_object_or_404(Group, id=recipient_id)
         if not GroupMember.objects.filter(group=group, user=request.user).exists():
             return HttpResponseForbidden("You are not a member of this group.")
-        messages = group.messages.all()
+        messages = messages_for(group_key(group.id)).filter(recipient_group=group)
     elif recipient_type == 'channel':
         channel = get_object_or_404(Channel, id=recipient_id)
         if not ChannelMember.objects.filter(channel=channel, user=request.user).exists():
             return HttpResponseForbidden("You are not a member of this channel.")
-        messages = channel.messages.all()
+        messages = messages_for(channel_key(channel.id)).filter(recipient_channel=channel)
     else:
         return HttpResponseBadRequest("Invalid recipient type.")
 
-    message_list = list(messages.values('id', 'sender__username', 'text', 'file', 'timestamp', 'is_deleted'))
-    for msg in message_list:
-        if msg['file']:
+    page = _page_params(request.GET)
+    if page is None:
+        return HttpResponseBadRequest("Invalid pagination parameters.")
+    return JsonResponse(_message_list(request, messages, **page), safe=False)
+
+
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+# Message ids are assigned before the INSERT commits, so a send can become visible after a
+# higher id was already read. `after` polls re-read the newest rows at or below the cursor
+# that are younger than this; a commit taking longer than that can still be missed.
+POLL_OVERLAP_SECONDS = 10
+POLL_OVERLAP_ROWS = MESSAGE_PAGE_DEFAULT
+MESSAGE_FIELDS = ('id', 'sender_id', 'text', 'file', 'timestamp', 'is_deleted', 'deleted_at') + ATTACHMENT_FIELDS
+
+
+def _with_usernames(rows):
+    """ Swaps sender_id for sender__username with one lookup on the primary (no cross-shard join). """
+    usernames = dict(User.objects.filter(id__in={row['sender_id'] for row in rows}).values_list('id', 'username'))
+    for row in rows:
+        row['sender__username'] = usernames.get(row.pop('sender_id'))
+    return rows
+
+
+def _page_params(params):
+    """ Reads optional before/after/limit/since cursors; returns None if any of them is malformed. """
+    page = {}
+    for name in ('before', 'after', 'limit'):
+        value = params.get(name)
+        if value in (None, ''):
+            continue
+        try:
+            page[name] = int(value)
+        except (TypeError, ValueError):
+            return None
+    since = params.get('since')
+    if since:
+        # Batch sub-requests are JSON, so this may be a number or anything else, not just a string.
+        if not isinstance(since, str):
+            return None
+        try:
+            page['since'] = parse_datetime(since)
+        except ValueError:
+            return None
+        if page['since'] is None:
+            return None
+    return page
+
+
+def _message_list(request, messages, before=None, after=None, limit=None, since=None):
+    """
+    Serializes a conversation. Without cursors the whole history is returned; with them,
+    one page of at most MESSAGE_PAGE_MAX messages, oldest first. With `after`, messages at
+    or below it that were deleted later than `since`, or sent in the last POLL_OVERLAP_SECONDS,
+    are included too, so a poll picks up new messages, late commits and fresh tombstones.
+    Deleted rows only ever go out as tombstones.
+    """
+    if before is None and after is None and limit is None:
+        # Live rows can come off the msg_*_live_idx partial indexes; tombstones are read without text or file.
+        live = list(messages.filter(is_deleted=False).values(*MESSAGE_FIELDS))
+        tombstones = list(messages.filter(is_deleted=True).values('id', 'sender_id', 'timestamp', 'is_deleted', 'deleted_at'))
+        message_list = list(heapq.merge(live, tombstones, key=lambda msg: msg['timestamp']))
+    else:
+        limit = max(1, min(limit or MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX))
+        if after is not None:
+            message_list = list(messages.filter(id__gt=after).order_by('id').values(*MESSAGE_FIELDS)[:limit])
+            # Bounded by row count so the re-read stays an index range scan, not a walk of the history.
+            cutoff = timezone.now() - timedelta(seconds=POLL_OVERLAP_SECONDS)
+            trailing = messages.filter(id__lte=after).order_by('-id').values(*MESSAGE_FIELDS)[:POLL_OVERLAP_ROWS]
+            earlier = {msg['id']: msg for msg in trailing if msg['timestamp'] >= cutoff}
+            if since is not None:
+                # `since` comes back from our own JSON, which keeps milliseconds only. Compare at that
+                # precision, or the newest tombstone would match its own truncated stamp on every poll.
+                since = since.replace(microsecond=since.microsecond // 1000 * 1000) + timedelta(milliseconds=1)
+                deleted = messages.filter(is_deleted=True, deleted_at__gte=since, id__lte=after)
+                earlier.update((msg['id'], msg) for msg in deleted.values(*MESSAGE_FIELDS))
+            message_list = sorted(earlier.values(), key=lambda msg: msg['id']) + message_list
+        else:
+            if before is not None:
+                messages = messages.filter(id__lt=before)
+            message_list = list(messages.order_by('-id').values(*MESSAGE_FIELDS)[:limit])[::-1]
+
+    for msg in _with_usernames(message_list):
+        if msg['is_deleted']:
+            msg['text'] = None
+            msg['file'] = None
+            msg.update(dict.fromkeys(ATTACHMENT_FIELDS))
+        elif msg['file']:
             msg['file'] = request.build_absolute_uri(settings.MEDIA_URL + msg['file'])
+    return message_list
+
+
+# --- Batch API ---
+class BatchAccess:
+    """ Loads the caller's memberships once so every sub-request in a batch shares them. """
+
+    def __init__(self, user):
+        self.user = user
+        self._member_of = None
+        self._users = {}
+
+    def is_member(self, item_type, item_id):
+        if self._member_of is None:
+            self._member_of = {
+                'group': set(GroupMember.objects.filter(user=self.user).values_list('group_id', flat=True)),
+                'channel': set(ChannelMember.objects.filter(user=self.user).values_list('channel_id', flat=True)),
+            }
+        return item_id in self._member_of[item_type]
+
+    def prefetch_users(self, user_ids):
+        missing = set(user_ids) - set(self._users)
+        if missing:
+            self._users.update(User.objects.in_bulk(missing))
+
+    def get_user(self, user_id):
+        return self._users.get(user_id)
+
+    def conversation(self, item_type, item_id, live=False):
+        """ Returns (messages, error) for one conversation, error being (status, message). `live` drops tombstones. """
+        if item_type == 'user':
+            other_user = self.get_user(item_id)
+            if other_user is None:
+                return None, (404, 'User not found.')
+            return dm_messages(self.user, other_user, live=live), None
+        if item_type in ('group', 'channel'):
+            if not self.is_member(item_type, item_id):
+                return None, (403, f'You are not a member of this {item_type}.')
+            messages = messages_for(key_for(item_type, item_id)).filter(**{f'recipient_{item_type}_id': item_id})
+            return (messages.filter(is_deleted=False) if live else messages), None
+        return None, (400, 'Invalid recipient type.')
+
+
+def _batch_messages(request, access, sub):
+    messages, error = access.conversation(sub.get('type'), sub.get('id'))
+    if error:
+        return error
+    page = _page_params(sub)
+    if page is None:
+        return 400, 'Invalid pagination parameters.'
+    return 200, _message_list(request, messages, **page)
+
+
+def _batch_members(request, access, sub):
+    item_type, item_id = sub.get('type'), sub.get('id')
+    if item_type not in ('group', 'channel'):
+        return 400, 'Invalid item type.'
+    if not access.is_member(item_type, item_id):
+        return 403, f'You are not a member of this {item_type}.'
+    member_model = GroupMember if item_type == 'group' else ChannelMember
+    members = member_model.objects.filter(**{f'{item_type}_id': item_id}).exclude(user=request.user)
+    return 200, [{'id': m['user_id'], 'username': m['user__username']}
+                 for m in members.values('user_id', 'user__username')]
+
+
+def _batch_summary(request, access, sub):
+    """
+    Count of live messages after the client's read marker, plus the latest one. The marker is
+    `after`, an id below which nothing can still commit, and `seen`, the ids above it the client
+    has already shown; a late commit in between is neither, so it is still counted.
+    """
+    live, error = access.conversation(sub.get('type'), sub.get('id'), live=True)
+    if error:
+        return error
+    page = _page_params(sub)
+    seen = sub.get('seen', [])
+    if (page is None or not isinstance(seen, list) or len(seen) > MESSAGE_PAGE_MAX
+            or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in seen)):
+        return 400, 'Invalid pagination parameters.'
+    latest = live.order_by('-id').values('id', 'sender_id', 'text', 'timestamp').first()
+    if latest:
+        _with_usernames([latest])
+    unread = live.filter(id__gt=page.get('after', 0)).exclude(id__in=seen).exclude(sender=request.user).count()
+    return 200, {'unread': unread, 'latest': latest}
+
+
+BATCH_OPS = {
+    'messages': _batch_messages,
+    'members': _batch_members,
+    'summary': _batch_summary,
+}
+BATCH_MAX_REQUESTS = 50
+
+
+@login_required
+@require_POST
+def batch(request):
+    """
+    Runs several read sub-requests in one round trip, e.g.
+    {"requests": [{"op": "messages", "type": "group", "id": 3, "limit": 50},
+                  {"op": "members", "type": "group", "id": 3},
+                  {"op": "summary", "type": "user", "id": 7, "after": 120, "seen": [123, 125]}]}
+    Each sub-request gets its own status, in order.
+    """
+    try:
+        sub_requests = json.loads(request.body).get('requests')
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+    if not isinstance(sub_requests, list) or len(sub_requests) > BATCH_MAX_REQUESTS:
+        return JsonResponse({'error': f'"requests" must be a list of at most {BATCH_MAX_REQUESTS} items.'}, status=400)
+
+    for sub in sub_requests:
+        if isinstance(sub, dict):
+            try:
+                sub['id'] = int(sub.get('id'))
+            except (TypeError, ValueError):
+                sub['id'] = None
+
+    access = BatchAccess(request.user)
+    access.prefetch_users(sub['id'] for sub in sub_requests
+                          if isinstance(sub, dict) and sub.get('type') == 'user' and sub['id'] is not None)
+
+    responses = []
+    for sub in sub_requests:
+        handler = BATCH_OPS.get(sub.get('op')) if isinstance(sub, dict) else None
+        if handler is None:
+            responses.append({'status': 400, 'error': 'Unknown op.'})
+            continue
+        status, body = handler(request, access, sub)
+        responses.append({'status': status, 'body': body} if status == 200 else {'status': status, 'error': body})
+    return JsonResponse({'responses': responses})
+
+
+# --- Export ---
+@login_required
+def export_messages(request):
+    recipient_type = request.GET.get('type')
+    recipient_id = request.GET.get('id')
+
+    if recipient_type == 'all':
+        messages = user_messages(request.user)
+        scope = {'user': request.user.username}
+        file_id = request.user.id
+    elif recipient_type == 'user':
+        other_user = get_object_or_404(User, id=recipient_id)
+        messages = dm_messages(request.user, other_user)
+        scope = {'users': [request.user.username, other_user.username]}
+        file_id = other_user.id
+    elif recipient_type == 'group':
+        group = get_object_or_404(Group, id=recipient_id)
+        if not GroupMember.objects.filter(group=group, user=request.user).exists():
+            return HttpResponseForbidden("You are not a member of this group.")
+        messages = messages_for(group_key(group.id)).filter(recipient_group=group)
+        scope = {'group': group.id}
+        file_id = group.id
+    elif recipient_type == 'channel':
+        channel = get_object_or_404(Channel, id=recipient_id)
+        if not ChannelMember.objects.filter(channel=channel, user=request.user).exists():
+            return HttpResponseForbidden("You are not a member of this channel.")
+        messages = messages_for(channel_key(channel.id)).filter(recipient_channel=channel)
+        scope = {'channel': channel.id}
+        file_id = channel.id
+    else:
+        return HttpResponseBadRequest("Invalid recipient type.")
+
+    response = StreamingHttpResponse(iter_ndjson(iter_records(messages, scope)), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="export-{recipient_type}-{file_id}.ndjson"'
+    return response
+
 
-    return JsonResponse(message_list, safe=False)
 @login_required
 def find_user(request, username):
     try:
-        user = User.objects.get(username__iexact=username)
+        user = get_user_by_username(username)
         return JsonResponse({'id': user.id, 'username': user.username})
     except User.DoesNotExist:
-        return JsonResponse({'error': 'User not found'}, status=404)
\ No newline at end of file
+        return JsonResponse({'error': 'User not found'}, status=404)
+
+
+@login_required
+def autocomplete_users(request):
+    """ Username prefix search for the add-contact and add-member dialogs; optionally skips current members. """
+    exclude_ids = {request.user.id}
+    item_type, item_id = request.GET.get('type'), request.GET.get('id', '')
+    members = None
+    if item_type == 'group' and item_id.isdigit():
+        members = GroupMember.objects.filter(group_id=item_id)
+    elif item_type == 'channel' and item_id.isdigit():
+        members = ChannelMember.objects.filter(channel_id=item_id)
+    if members is not None:
+        member_ids = set(members.values_list('user_id', flat=True))
+        if request.user.id in member_ids:
+            exclude_ids |= member_ids
+    return JsonResponse(username_index.search(request.GET.get('q', ''), AUTOCOMPLETE_LIMIT, exclude_ids), safe=False)
+
+
+# --- Presence & Typing (in-memory, no database writes) ---
+@login_required
+@require_POST
+def presence_heartbeat(request):
+    get_presence_backend().touch(online_key(request.user.id), presence_settings()['ONLINE_TTL'])
+    return JsonResponse({'success': True})
+
+
+@login_required
+@require_POST
+def typing(request):
+    data = json.loads(request.body)
+    recipient_type = data.get('type')
+    recipient_id = data.get('id')
+
+    if recipient_type == 'group':
+        if not GroupMember.objects.filter(group_id=recipient_id, user=request.user).exists():
+            return HttpResponseForbidden("You are not a member of this group.")
+    elif recipient_type == 'channel':
+        if not ChannelMember.objects.filter(channel_id=recipient_id, user=request.user, can_send_messages=True).exists():
+            return HttpResponseForbidden("You don't have permission to send messages in this channel.")
+    elif recipient_type == 'user':
+        recipient_id = get_object_or_404(User, id=recipient_id).id
+    else:
+        return HttpResponseBadRequest("Invalid recipient type.")
+
+    backend = get_presence_backend()
+    options = presence_settings()
+    backend.touch(typing_key(recipient_type, recipient_id, request.user.id), options['TYPING_TTL'])
+    backend.touch(online_key(request.user.id), options['ONLINE_TTL'])
+    return JsonResponse({'success': True})
+
+
+@login_required
+def get_presence(request):
+    recipient_type = request.GET.get('type')
+    recipient_id = request.GET.get('id')
+
+    if recipient_type == 'user':
+        other_user = get_object_or_404(User, id=recipient_id)
+        members = [{'id': other_user.id, 'username': other_user.username}]
+        # A DM typing key is addressed to the reader, so look it up from their side.
+        typing_keys = {typing_key('user', request.user.id, other_user.id): other_user.username}
+    elif recipient_type in ('group', 'channel'):
+        member_model = GroupMember if recipient_type == 'group' else ChannelMember
+        lookup = {f'{recipient_type}_id': recipient_id}
+        if not member_model.objects.filter(user=request.user, **lookup).exists():
+            return HttpResponseForbidden(f"You are not a member of this {recipient_type}.")
+        members = list(member_model.objects.filter(**lookup).exclude(user=request.user)
+                       .values('user_id', 'user__username'))
+        members = [{'id': m['user_id'], 'username': m['user__username']} for m in members]
+        typing_keys = {typing_key(recipient_type, recipient_id, m['id']): m['username'] for m in members}
+    else:
+        return HttpResponseBadRequest("Invalid recipient type.")
+
+    backend = get_presence_backend()
+    online = backend.alive(online_key(m['id']) for m in members)
+    typing_now = backend.alive(typing_keys)
+    return JsonResponse({
+        'online': [m['username'] for m in members if online_key(m['id']) in online],
+        'typing': [typing_keys[key] for key in typing_keys if key in typing_now],
+    })
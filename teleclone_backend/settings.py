@@ -81,6 +81,24 @@ DATABASES = {
     }
 }
 
+# Messages are placed per conversation across CHAT_MESSAGE_SHARDS (see chat/sharding.py);
+# everything else stays on 'default'. To split message storage, add databases and list them:
+#
+#     DATABASES['messages_1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'messages_1.sqlite3'}
+#     CHAT_MESSAGE_SHARDS = ['default', 'messages_1']
+#
+# then run `manage.py migrate --database=messages_1`. Existing conversations stay on 'default' and
+# new ones are spread by hash; `manage.py rebalance_shards --record-only` records the existing ones
+# up front. Move or split them later with rebalance_shards.
+#
+# With more than one shard, message ids embed a node id that each process leases from the
+# MessageIdNode table on 'default' (64 nodes, so at most 64 processes writing messages at once).
+# A lease lasts CHAT_NODE_LEASE_SECONDS and is renewed while the process keeps sending; a node
+# left behind by a crashed process is reused once its lease runs out.
+DATABASE_ROUTERS = ['chat.routers.MessageShardRouter']
+CHAT_MESSAGE_SHARDS = ['default']
+CHAT_NODE_LEASE_SECONDS = 600
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -124,3 +142,29 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Chat presence & typing indicators (kept in memory, never written to the database).
+# Switch BACKEND to 'chat.presence.CachePresenceBackend' and point CACHES at a shared
+# cache (Redis, Memcached) when running more than one worker.
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.InMemoryPresenceBackend',
+    'ONLINE_TTL': 60,
+    'TYPING_TTL': 6,
+}
+
+# Scheduled messages are sent by `manage.py run_scheduler`. For a single-process setup such as
+# runserver, AUTOSTART runs the scheduler thread inside the web process instead.
+CHAT_SCHEDULER = {
+    'AUTOSTART': False,
+    'BATCH_SIZE': 200,
+    'HORIZON': 3600,
+}
+
+# Group commit for sends: concurrent text messages arriving within WINDOW_MS are inserted
+# together in one transaction. Mostly worth it on SQLite, where every commit is an fsync.
+CHAT_GROUP_COMMIT = {
+    'ENABLED': False,
+    'WINDOW_MS': 5,
+    'MAX_BATCH': 200,
+}
@@ -0,0 +1,17 @@
+"""
+Settings for running the test suite against two message shards:
+
+    python manage.py test chat --settings=teleclone_backend.test_settings
+
+The sharding tests are skipped under the regular settings, which keep a single database.
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    **DATABASES,
+    'messages_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'messages_1.sqlite3',
+    },
+}
+CHAT_MESSAGE_SHARDS = ['default', 'messages_1']